@@ -0,0 +1,88 @@
+"""
+Decode all the CWA files in data/ into parquet files in data/accel/
+
+Files are decoded in parallel; files that have already been converted are
+skipped, so this can be re-run to pick up where it left off.
+
+"""
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from ema import read
+
+
+def _convert(cwa_path) -> int:
+    """
+    Convert one file, returning the number of samples
+
+    Exceptions are re-raised as a string so the main process can report them
+    even if the original exception can't be pickled
+
+    """
+    try:
+        return read.convert_accel(cwa_path)
+    except Exception:
+        raise RuntimeError(traceback.format_exc()) from None
+
+
+def main(*, n_workers: int, force: bool):
+    """
+    Find, check and convert the CWA files
+
+    """
+    files = read.cwa_files()
+    print(f"Found {len(files)} CWA files")
+
+    # Check consent for every participant at once
+    # Participants who aren't in the questionnaire are treated as not consenting
+    consented = read.participant_facts(files["p_id"], ["consented"])["consented"]
+    consented = consented.eq(True)
+    for row in files[~consented].itertuples():
+        print(f"Skipping {row.path.name}: participant {row.p_id} didn't consent")
+    files = files[consented]
+
+    if not force:
+        done = files["path"].map(read.is_converted)
+        print(f"Skipping {done.sum()} files that are already converted")
+        files = files[~done]
+
+    failures = {}
+    n_samples = 0
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_convert, path): path for path in files["path"]}
+
+        progress = tqdm(as_completed(futures), total=len(futures), unit="file")
+        for future in progress:
+            path = futures[future]
+            progress.set_postfix_str(path.name)
+            try:
+                n_samples += future.result()
+            except Exception as e:
+                failures[path] = e
+
+    print(f"Converted {len(files) - len(failures)} files ({n_samples} samples)")
+    if failures:
+        print(f"{len(failures)} files failed:")
+        for path, e in failures.items():
+            print(f"{path.name}:\n{e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-n",
+        "--n-workers",
+        type=int,
+        default=None,
+        help="number of processes to use; defaults to the number of CPUs",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="convert files even if they have already been converted",
+    )
+
+    main(**vars(parser.parse_args()))
@@ -2,12 +2,17 @@
 Helpers to wrap up concepts for analysis stuff
 
 """
+from functools import cache
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 
 from scipy.signal import convolve
 from scipy import integrate as sciint
 
+from . import clean
+
 
 def magnitude(accel_df: pd.DataFrame) -> np.ndarray:
     """
@@ -63,3 +68,354 @@ def find_participant_entries(
         participant_entries[participant] = (dates, entries_per_day)
 
     return participant_entries
+
+
+def resample_battery(
+    battery_df: pd.DataFrame,
+    *,
+    step: pd.Timedelta = pd.Timedelta(minutes=5),
+    since_distribution: bool = False,
+    max_gap: pd.Timedelta = pd.Timedelta(hours=1),
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Linearly interpolate every participant's battery level onto a common time grid
+
+    Does all the participants at once - each participant's readings are shifted along
+    the time axis so that they don't overlap, then interpolated in one go.
+
+    :param battery_df: dataframe of battery levels indexed by datetime, with p_id and
+                       battery_lvl (and delta, if since_distribution) columns;
+                       e.g. read.battery_lvl_df().set_index("Datetime")
+    :param step: spacing of the grid
+    :param since_distribution: whether the grid is of time since watch distribution (the delta column)
+                               instead of datetimes
+    :param max_gap: grid points between readings further apart than this are marked as gaps
+
+    :returns: array of participant IDs
+    :returns: the grid; array of datetimes, or timedeltas if since_distribution
+    :returns: (participants x grid) array of battery levels; NaN in gaps
+    :returns: (participants x grid) boolean array; True where there's a gap - either no
+              readings before/after the grid point, or the readings either side are too far apart
+
+    """
+    times = (
+        battery_df["delta"].values if since_distribution else battery_df.index.values
+    )
+    p_ids, codes = np.unique(battery_df["p_id"].values, return_inverse=True)
+
+    # Work in seconds since the start of the grid
+    origin = (pd.Timedelta if since_distribution else pd.Timestamp)(times.min())
+    origin = origin.floor(step).to_numpy()
+    seconds = (times - origin) / np.timedelta64(1, "s")
+    grid_seconds = np.arange(0, seconds.max() + 1e-9, step / pd.Timedelta(seconds=1))
+    grid = origin + (grid_seconds * 1e9).astype("timedelta64[ns]")
+
+    # Sort by participant, then time
+    order = np.lexsort((seconds, codes))
+    codes, levels = codes[order], battery_df["battery_lvl"].values[order].astype(float)
+
+    # Shift each participant onto its own stretch of the time axis
+    # The stride must be longer than any participant's readings and the grid,
+    # which starts less than one step before the first reading
+    stride = seconds.max() - seconds.min() + step / pd.Timedelta(seconds=1)
+    shifted = seconds[order] + codes * stride
+    query = (
+        grid_seconds[np.newaxis, :] + np.arange(len(p_ids))[:, np.newaxis] * stride
+    ).ravel()
+    query_codes = np.repeat(np.arange(len(p_ids)), len(grid_seconds))
+
+    resampled = np.interp(query, shifted, levels)
+
+    # Find the readings either side of each grid point
+    after = np.searchsorted(shifted, query, side="left")
+    before = np.clip(after - 1, 0, len(shifted) - 1)
+    after = np.clip(after, 0, len(shifted) - 1)
+
+    exact = (shifted[after] == query) & (codes[after] == query_codes)
+    bracketed = (
+        (codes[before] == query_codes)
+        & (codes[after] == query_codes)
+        & (shifted[before] <= query)
+        & (query <= shifted[after])
+        & (shifted[after] - shifted[before] <= max_gap / pd.Timedelta(seconds=1))
+    )
+    gaps = ~(exact | bracketed)
+    resampled[gaps] = np.nan
+
+    shape = (len(p_ids), len(grid_seconds))
+    return p_ids, grid, resampled.reshape(shape), gaps.reshape(shape)
+
+
+def _search_entries(
+    participants: list[tuple[np.ndarray, np.ndarray]]
+) -> list[np.ndarray]:
+    """
+    For each participant, find the entry following each epoch
+
+    :param participants: list of (epoch times, sorted entry times) for each
+                         participant, as int64 nanoseconds
+
+    :returns: for each participant, the position in its entry times of the first
+              entry after each epoch. The entry before (or at the same time as) the
+              epoch is at the position before this
+
+    """
+    return [
+        np.searchsorted(entry_times, epoch_times, side="right")
+        for epoch_times, entry_times in participants
+    ]
+
+
+def nearest_entries(
+    epochs: pd.DataFrame, entries: pd.DataFrame, *, n_workers: int = 1
+) -> pd.DataFrame:
+    """
+    Find the smartwatch entries either side of each accelerometer epoch
+
+    For every epoch, finds the participant's last entry at or before it and their
+    first entry after it, using a sorted search over each participant's entry times.
+
+    :param epochs: dataframe with p_id and time (e.g. start of each epoch) columns
+    :param entries: smartwatch entries indexed by datetime with p_id and meal_type
+                    columns; e.g. from clean.cleaned_smartwatch
+    :param n_workers: number of processes to search participants in
+
+    :returns: dataframe with the same index as `epochs`, with columns:
+              prev_entry, prev_meal_type, time_since_prev,
+              next_entry, next_meal_type, time_to_next.
+              NaT/NaN where the participant has no entry before/after the epoch
+
+    """
+    assert n_workers >= 1
+
+    # Sort the entries by participant, then time
+    entry_p_ids = entries["p_id"].values
+    entry_times = entries.index.values.astype("datetime64[ns]").view(np.int64)
+    order = np.lexsort((entry_times, entry_p_ids))
+    entry_p_ids, entry_times = entry_p_ids[order], entry_times[order]
+
+    # Add a dummy entry at the end to look up when there isn't one
+    missing = len(entry_times)
+    entry_times = np.append(entry_times, np.datetime64("NaT").astype(np.int64))
+    meal_types = np.append(entries["meal_type"].values[order], None)
+
+    epoch_times = epochs["time"].values.astype("datetime64[ns]").view(np.int64)
+    rows = pd.Series(epochs["p_id"].values).groupby(epochs["p_id"].values).indices
+
+    # Each participant's entries are a contiguous slice of the sorted entries
+    p_ids = list(rows)
+    starts = np.searchsorted(entry_p_ids, p_ids, side="left")
+    ends = np.searchsorted(entry_p_ids, p_ids, side="right")
+    participants = [
+        (epoch_times[rows[p_id]], entry_times[start:end])
+        for p_id, start, end in zip(p_ids, starts, ends)
+    ]
+
+    if n_workers == 1:
+        following = _search_entries(participants)
+    else:
+        # Split the participants into one shard per worker
+        shard_size = -(-len(participants) // n_workers)
+        shards = [
+            participants[i : i + shard_size]
+            for i in range(0, len(participants), shard_size)
+        ]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            following = [
+                after
+                for shard_result in executor.map(_search_entries, shards)
+                for after in shard_result
+            ]
+
+    # Convert to positions in the sorted entries
+    prev_pos = np.full(len(epochs), missing)
+    next_pos = np.full(len(epochs), missing)
+    for p_id, start, end, after in zip(p_ids, starts, ends, following):
+        prev_pos[rows[p_id]] = np.where(after > 0, start + after - 1, missing)
+        next_pos[rows[p_id]] = np.where(start + after < end, start + after, missing)
+
+    prev_times = entry_times[prev_pos].view("datetime64[ns]")
+    next_times = entry_times[next_pos].view("datetime64[ns]")
+    epoch_times = epoch_times.view("datetime64[ns]")
+
+    return pd.DataFrame(
+        {
+            "prev_entry": prev_times,
+            "prev_meal_type": meal_types[prev_pos],
+            "time_since_prev": epoch_times - prev_times,
+            "next_entry": next_times,
+            "next_meal_type": meal_types[next_pos],
+            "time_to_next": next_times - epoch_times,
+        },
+        index=epochs.index,
+    )
+
+
+class ComplianceCube:
+    """
+    Dense array of entry counts by participant, study day and meal type
+    (and optionally hour of day)
+
+    Build one with `ComplianceCube.from_entries` or `compliance_cube`, then slice
+    it by label with `counts` or sum it down to some axes with `marginal`.
+
+    """
+
+    # Meal types that count as the participant responding
+    RESPONSES = ("Meal", "Drink", "Snack", "No food/drink")
+
+    def __init__(self, counts: np.ndarray, labels: dict[str, np.ndarray]):
+        """
+        :param counts: integer array of counts, with one axis per label
+        :param labels: dict of {axis name: array of labels along that axis}
+
+        """
+        assert counts.shape == tuple(len(axis) for axis in labels.values())
+
+        self.values = counts
+        self.labels = labels
+        self.axes = tuple(labels)
+
+    @classmethod
+    def from_entries(
+        cls, meal_info: pd.DataFrame, *, by_hour: bool = False
+    ) -> "ComplianceCube":
+        """
+        Count the entries in a dataframe
+
+        :param meal_info: smartwatch entries indexed by datetime with p_id, meal_type
+                          and delta (time since watch distribution) columns; e.g.
+                          from clean.cleaned_smartwatch
+        :param by_hour: whether to also split the counts by hour of day
+
+        """
+        p_ids, p_codes = np.unique(meal_info["p_id"].values, return_inverse=True)
+        meal_types, type_codes = np.unique(
+            meal_info["meal_type"].values.astype(str), return_inverse=True
+        )
+
+        days = meal_info["delta"].dt.days.values
+        first_day = days.min() if len(days) else 0
+        days = days - first_day
+        day_labels = np.arange(
+            first_day, first_day + days.max() + 1 if len(days) else 0
+        )
+
+        labels = {"p_id": p_ids, "day": day_labels, "meal_type": meal_types}
+        codes = [p_codes, days, type_codes]
+        if by_hour:
+            labels["hour"] = np.arange(24)
+            codes.append(meal_info.index.hour.values)
+
+        shape = tuple(len(axis) for axis in labels.values())
+        flat = np.ravel_multi_index(codes, shape) if len(days) else np.array([], int)
+
+        return cls(np.bincount(flat, minlength=np.prod(shape)).reshape(shape), labels)
+
+    def counts(self, **selection) -> np.ndarray:
+        """
+        Slice the cube by label, keeping every axis
+
+        e.g. cube.counts(p_id=[1234, 5678], meal_type=["Meal", "Snack"])
+
+        :param selection: for each axis to slice, the labels to keep along it
+        :returns: array of counts; axes in the same order as `self.axes`
+
+        """
+        assert set(selection) <= set(self.axes), f"Unknown axes: {set(selection)}"
+
+        positions = []
+        for axis in self.axes:
+            labels = self.labels[axis]
+            if axis not in selection:
+                positions.append(np.arange(len(labels)))
+                continue
+
+            wanted = np.atleast_1d(selection[axis])
+            found = np.clip(np.searchsorted(labels, wanted), 0, len(labels) - 1)
+            assert len(labels) and (labels[found] == wanted).all(), f"Unknown {axis}"
+            positions.append(found)
+
+        return self.values[np.ix_(*positions)]
+
+    def marginal(self, *axes: str, **selection) -> pd.Series | pd.DataFrame:
+        """
+        Sum the counts over every axis apart from the given ones
+
+        e.g. cube.marginal("p_id", "day") for the number of entries each participant
+        made each day, or cube.marginal("hour", meal_type=["Meal"]) for the number
+        of meals by hour of day
+
+        :param axes: the axes to keep; one or two of them
+        :param selection: labels to select before summing, as for `counts`
+
+        :returns: a series (one axis) or dataframe (two axes, the first as the index)
+                  of counts, labelled by the axes' labels
+
+        """
+        assert 1 <= len(axes) <= 2, "Can only keep one or two axes"
+        assert set(axes) <= set(self.axes), f"Unknown axes: {set(axes)}"
+
+        counts = self.counts(**selection)
+        labels = {
+            axis: np.atleast_1d(selection[axis])
+            if axis in selection
+            else self.labels[axis]
+            for axis in axes
+        }
+
+        summed = counts.sum(
+            axis=tuple(i for i, axis in enumerate(self.axes) if axis not in axes)
+        )
+        # Put the axes in the order they were asked for
+        if [axis for axis in self.axes if axis in axes] != list(axes):
+            summed = summed.T
+
+        if len(axes) == 1:
+            return pd.Series(summed, index=pd.Index(labels[axes[0]], name=axes[0]))
+
+        return pd.DataFrame(
+            summed,
+            index=pd.Index(labels[axes[0]], name=axes[0]),
+            columns=pd.Index(labels[axes[1]], name=axes[1]),
+        )
+
+    def response_rate(self, *axes: str) -> pd.Series | pd.DataFrame:
+        """
+        Fraction of entries that were responses (i.e. not "No response")
+
+        :param axes: the axes to keep, as for `marginal`. Can't include meal_type
+        :returns: series or dataframe of fractions; NaN where there were no entries
+
+        """
+        assert "meal_type" not in axes
+
+        responses = [
+            meal_type
+            for meal_type in self.RESPONSES
+            if meal_type in self.labels["meal_type"]
+        ]
+        total = self.marginal(*axes)
+        if not responses:
+            return total * 0.0
+
+        return self.marginal(*axes, meal_type=responses) / total.where(total > 0)
+
+
+@cache
+def compliance_cube(
+    *, keep_catchups: bool = False, by_hour: bool = False
+) -> ComplianceCube:
+    """
+    Entry counts from the cleaned smartwatch data, by participant, study day and
+    meal type (and optionally hour of day)
+
+    Cached, so the notebooks can all use the same cube
+
+    :param keep_catchups: whether to count catchup markers and entries
+    :param by_hour: whether to also split the counts by hour of day
+
+    """
+    return ComplianceCube.from_entries(
+        clean.cleaned_smartwatch(keep_catchups=keep_catchups), by_hour=by_hour
+    )
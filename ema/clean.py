@@ -3,12 +3,30 @@ Data cleaning stuff
 
 """
 
-import warnings
+import os
+import json
+import hashlib
+import pathlib
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 
-from . import util, read
+from . import util, read, diagnostics
+
+# Per-participant columns added when cleaning
+PARTICIPANT_FLAGS = [
+    "early_stop",
+    "first_in_ramadan",
+    "last_in_ramadan",
+    "all_in_ramadan",
+    "any_in_ramadan",
+]
+
+# Keys in config.yaml of the raw files that the cleaned entries are made from:
+# the smartwatch entries, and the feasibility data holding the distribution dates
+STORE_SOURCES = ("meal_info", "feasibility_info")
 
 
 def duplicates(meal_info: pd.DataFrame, delta_minutes: int = 5) -> pd.Series:
@@ -76,7 +94,8 @@ def flag_catchups(meal_info: pd.DataFrame) -> pd.DataFrame:
 
     # Add a new column
     col_name = "catchup_category"
-    copy["catchup_category"] = np.nan
+    # Object dtype, so the categories can be assigned to it
+    copy["catchup_category"] = np.full(len(copy), np.nan, dtype=object)
 
     # Iterate rows
     # Slow, but it's fine
@@ -120,8 +139,11 @@ def flag_catchups(meal_info: pd.DataFrame) -> pd.DataFrame:
 
     # We've reached the end of the dataframe, but are still in a catchup. This means it's open-ended
     if in_catchup:
-        warnings.warn(
-            "Reached end of dataframe while in catchup: the last entry is open-ended"
+        diagnostics.record(
+            "flag_catchups",
+            "reached the end of the entries while in a catch-up: it is open-ended",
+            p_id=copy.loc[start_time, "p_id"] if "p_id" in copy else None,
+            time=start_time,
         )
         copy.loc[start_time, col_name] = "Open-ended"
 
@@ -185,12 +207,13 @@ def flag_catchup_entries(meal_info: pd.DataFrame) -> pd.DataFrame:
                 next_row["meal_type"] == "No response"
             ), "Long catchup not started with no response"
 
-            # Warn the user (me) that we're assuming the next entry isn't a real catch-up
+            # Record that we're assuming the next entry isn't a real catch-up
             next_time, next_row = next(iterator, None)
-            warnings.warn(
-                f"{util.bcolour.OKBLUE}Long catchup: not marking"
-                f" {next_row['meal_type']} at {next_time} as catchup"
-                f"{util.bcolour.ENDC}"
+            diagnostics.record(
+                "flag_catchup_entries",
+                f"long catch-up: not marking {next_row['meal_type']} as catch-up",
+                p_id=next_row.get("p_id"),
+                time=next_time,
             )
 
             # Check that the next entry is the end of the catch-up period
@@ -207,25 +230,46 @@ def flag_catchup_entries(meal_info: pd.DataFrame) -> pd.DataFrame:
             n_open_ended += 1
             # Look through rows
             while True:
-                next_time, next_row = next(iterator, None)
+                following = next(iterator, None)
+
+                # If we run out of entries, then the catch-up period ends with them
+                if following is None:
+                    diagnostics.record(
+                        "flag_catchup_entries",
+                        "open-ended catch-up ended by the end of the entries",
+                        p_id=row.get("p_id"),
+                        time=time,
+                    )
+                    break
+
+                next_time, next_row = following
                 # If we encounter a No catch-up, then we're out of the catch-up period
                 if next_row["meal_type"] == "No catch-up":
-                    print(
-                        f" Open ended catchup at {util.bcolour.WARNING}{time}{util.bcolour.ENDC} ended by No catch-up at {util.bcolour.WARNING}{next_time}{util.bcolour.ENDC}"
+                    diagnostics.record(
+                        "flag_catchup_entries",
+                        f"open-ended catch-up ended by No catch-up at {next_time}",
+                        p_id=row.get("p_id"),
+                        time=time,
                     )
                     break
 
                 # If we encounter a No Response, then we're out of the catch-up period
                 if next_row["meal_type"] == "No response":
-                    print(
-                        f" Open ended catchup at {util.bcolour.OKGREEN}{time}{util.bcolour.ENDC} ended by No response at {util.bcolour.OKGREEN}{next_time}{util.bcolour.ENDC}"
+                    diagnostics.record(
+                        "flag_catchup_entries",
+                        f"open-ended catch-up ended by No response at {next_time}",
+                        p_id=row.get("p_id"),
+                        time=time,
                     )
                     break
 
                 # If we encounter a time > 30 minutes after the start, then we're out of the catch-up period
                 if (next_time - time) > pd.Timedelta(minutes=30):
-                    print(
-                        f" Open ended catchup at {util.bcolour.FAIL}{time}{util.bcolour.ENDC} ended by long wait at {util.bcolour.FAIL}{next_time}{util.bcolour.ENDC}"
+                    diagnostics.record(
+                        "flag_catchup_entries",
+                        f"open-ended catch-up ended by long wait at {next_time}",
+                        p_id=row.get("p_id"),
+                        time=time,
                     )
                     break
 
@@ -234,8 +278,11 @@ def flag_catchup_entries(meal_info: pd.DataFrame) -> pd.DataFrame:
                     next_row["meal_type"] == "Catch-up start"
                     and next_row["catchup_category"] != "Open-ended"
                 ):
-                    print(
-                        f" Open ended catchup at {util.bcolour.FAIL}{time}{util.bcolour.ENDC} ended by Catch-up start at {util.bcolour.FAIL}{next_time}{util.bcolour.ENDC}"
+                    diagnostics.record(
+                        "flag_catchup_entries",
+                        f"open-ended catch-up ended by Catch-up start at {next_time}",
+                        p_id=row.get("p_id"),
+                        time=time,
                     )
                     break
 
@@ -251,10 +298,33 @@ def flag_catchup_entries(meal_info: pd.DataFrame) -> pd.DataFrame:
                     raise ValueError(f"{time}, {next_time}")
 
     # Just to check sanity
-    print(f"{n_open_ended=}")
+    diagnostics.record("flag_catchup_entries", f"{n_open_ended=}")
     return copy
 
 
+def flag_participant_catchups(meal_info: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add the "catchup_category" and "catchup_flag" columns one participant at a time
+
+    `flag_catchups` and `flag_catchup_entries` walk through the rows in order,
+    so this stops a catch-up at the end of one participant's entries from running
+    on into the next participant's. Any subset of whole participants gets the
+    same flags as it would as part of the whole dataframe.
+
+    :param meal_info: dataframe holding smartwatch entries, with a p_id column
+    :returns: a new dataframe with the columns added, with the rows in the same order
+
+    """
+    groups = list(meal_info.groupby("p_id", sort=False, dropna=False).indices.values())
+    if len(groups) <= 1:
+        return flag_catchup_entries(flag_catchups(meal_info))
+
+    flagged = pd.concat(
+        [flag_catchup_entries(flag_catchups(meal_info.iloc[rows])) for rows in groups]
+    )
+    return flagged.iloc[np.argsort(np.concatenate(groups), kind="stable")]
+
+
 def remove_catchups(meal_info: pd.DataFrame) -> pd.DataFrame:
     """
     From a dataframe of meal info, remove the catch-up entries and their flags
@@ -285,20 +355,17 @@ def _ramadan_info(meal_info: pd.DataFrame, verbose: bool) -> pd.DataFrame:
     """
     Information about whether the participant's period intersected with Ramadan
 
+    :returns: dataframe indexed by p_id
+
     """
     # Whether the first and last entry for this participant was within Ramadan
     first, last = _first_last_date(meal_info)
-    ramadan_df = (
-        util.in_ramadan_2022(first, verbose=verbose)
-        .to_frame()
-        .rename(columns={"Datetime": "first_in_ramadan"})
-    )  # Find whether the first entry was in ramadan
-    ramadan_df = ramadan_df.merge(
-        util.in_ramadan_2022(last, verbose=verbose)
-        .to_frame()
-        .rename(columns={"Datetime": "last_in_ramadan"}),
-        on="p_id",
-    )  # Find whether the last entry was in ramadan, and add it to the df
+    ramadan_df = pd.DataFrame(
+        {
+            "first_in_ramadan": util.in_ramadan_2022(first, verbose=verbose),
+            "last_in_ramadan": util.in_ramadan_2022(last, verbose=verbose),
+        }
+    )
 
     ramadan_df["all_in_ramadan"] = (
         ramadan_df["first_in_ramadan"] & ramadan_df["last_in_ramadan"]
@@ -311,31 +378,65 @@ def _ramadan_info(meal_info: pd.DataFrame, verbose: bool) -> pd.DataFrame:
     return ramadan_df
 
 
-def clean_meal_info(
-    meal_df: pd.DataFrame, *, keep_catchups: bool, verbose: bool = False
-) -> pd.DataFrame:
+def _early_stop(meal_info: pd.DataFrame) -> pd.Series:
     """
-    Clean the provided meal info dataframe.
+    Whether each participant's last positive entry was before day 7
 
-    Returns a dataframe of meal time info that has:
-        - had duplicates removed (as defined above)
-        - had events before the participant watch distribution date removed
-        - had events on the watch distribution date removed
-        - had events more than 7 days after the distribution date removed
+    :returns: boolean series indexed by p_id
 
-    :param meal_df: dataframe of meal info
-    :param keep_catchups: whether to keep catchup markers and entries
-    :param verbose: extra print information
+    """
+    positive = meal_info["meal_type"].isin({"Meal", "Drink", "Snack", "No food/drink"})
+    last_entry = (
+        meal_info.loc[positive, "delta"]
+        .dt.days.groupby(meal_info.loc[positive, "p_id"])
+        .max()
+    )
+
+    # Participants with no positive entries aren't counted as stopping early
+    return last_entry.reindex(meal_info["p_id"].unique()) < 7
 
-    :returns: a cleaned copy of the dataframe
 
+def _add_participant_flags(meal_info: pd.DataFrame, verbose: bool) -> pd.DataFrame:
     """
-    retval = meal_df.copy()
+    Add the per-participant early stopping and Ramadan columns to a dataframe of entries
 
-    retval = retval.sort_index(inplace=False)
+    Finds them once per participant, then broadcasts them onto the entries
+
+    """
+    flags = _ramadan_info(meal_info, verbose=verbose)
+    flags.insert(0, "early_stop", _early_stop(meal_info).reindex(flags.index))
+
+    for column, values in util.broadcast(flags, meal_info["p_id"]).items():
+        meal_info[column] = values
+
+    return meal_info
+
+
+def _sort_entries(meal_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sort entries by time, then by participant
+
+    Entries at the same time keep their order within each participant, so the
+    result doesn't depend on how the participants' rows were interleaved -
+    e.g. whether they came from the smartwatch CSV or the store of cleaned entries
+
+    """
+    return meal_df.iloc[np.lexsort((meal_df["p_id"].values, meal_df.index.values))]
+
+
+def _clean_meal_info(
+    meal_df: pd.DataFrame, *, first_day: int, keep_catchups: bool, verbose: bool
+) -> pd.DataFrame:
+    """
+    The cleaning chain; every step only depends on one participant's entries
+
+    :param first_day: entries before this many days after the distribution date are removed
+
+    """
+    retval = _sort_entries(meal_df.copy())
 
     # Find early entries
-    retval = retval[retval["delta"].dt.days >= 1]
+    retval = retval[retval["delta"].dt.days >= first_day]
 
     # Fine late entries
     retval = retval[retval["delta"].dt.days <= 7]
@@ -351,33 +452,76 @@ def clean_meal_info(
     # Whether each entry was within Ramadan
     retval["entry_in_ramadan"] = util.in_ramadan_2022(retval.index, verbose=verbose)
 
-    # Whether the participants period was within Ramadan
-    ramadan_info = _ramadan_info(retval, verbose=verbose)
+    # Whether the participant's last positive entry was on day 7,
+    # and whether the participants period was within Ramadan
+    return _add_participant_flags(retval, verbose=verbose)
 
-    # Whether the participant's last positive entry was on day 7
-    last_entry = {
-        p_id: retval[
-            (retval["p_id"] == p_id)
-            & (retval["meal_type"].isin({"Meal", "Drink", "Snack", "No food/drink"}))
-        ]["delta"].dt.days.max()
-        for p_id in retval["p_id"].unique()
-    }
-    retval["early_stop"] = False
-    for pid in retval["p_id"].unique():
-        if last_entry[pid] < 7:
-            retval.loc[retval["p_id"] == pid, "early_stop"] = True
 
-    # Need to do this to preserve the index
-    retval["Datetime"] = retval.index
-    return retval.merge(ramadan_info, on="p_id").set_index("Datetime").sort_index()
+def _clean_in_parallel(
+    meal_df: pd.DataFrame, *, n_workers: int, shard_size: int, **clean_kw
+) -> pd.DataFrame:
+    """
+    Run the cleaning chain on shards of participants in a process pool
 
+    Gives exactly the same dataframe as running it on the whole dataframe:
+    the shards are cleaned independently, then the rows are put back in the
+    order they would have had in the serial run.
 
-def cleaned_smartwatch(*, keep_catchups: bool) -> pd.DataFrame:
-    return clean_meal_info(read.all_meal_info(), keep_catchups=keep_catchups)
+    """
+    # Sort here so that we know the order the serial run would have put the rows in
+    meal_df = _sort_entries(meal_df)
+    meal_df = meal_df.assign(_row=np.arange(len(meal_df)))
+
+    # Assign whole participants to shards
+    p_ids = meal_df["p_id"].unique()
+    if shard_size is None:
+        shard_size = -(-len(p_ids) // n_workers)
+    shard_numbers = pd.Series(np.arange(len(p_ids)) // shard_size, index=p_ids)
+    shards = [
+        shard
+        for _, shard in meal_df.groupby(
+            shard_numbers.reindex(meal_df["p_id"]).values, sort=True
+        )
+    ]
 
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(partial(_clean_meal_info, **clean_kw), shards))
 
-def clean_meal_info_keepday0(
-    meal_df: pd.DataFrame, *, keep_catchups: bool, verbose: bool = False
+    retval = pd.concat(results)
+    retval = retval.iloc[np.argsort(retval["_row"].values, kind="stable")]
+
+    return retval.drop(columns="_row")
+
+
+def _clean(
+    meal_df: pd.DataFrame,
+    *,
+    n_workers: int,
+    shard_size: int,
+    **clean_kw,
+) -> pd.DataFrame:
+    """
+    Run the cleaning chain, in parallel if more than one worker is requested
+
+    """
+    assert n_workers >= 1
+    assert shard_size is None or shard_size >= 1
+
+    if n_workers == 1 or meal_df.empty:
+        return _clean_meal_info(meal_df, **clean_kw)
+
+    return _clean_in_parallel(
+        meal_df, n_workers=n_workers, shard_size=shard_size, **clean_kw
+    )
+
+
+def clean_meal_info(
+    meal_df: pd.DataFrame,
+    *,
+    keep_catchups: bool,
+    verbose: bool = False,
+    n_workers: int = 1,
+    shard_size: int = None,
 ) -> pd.DataFrame:
     """
     Clean the provided meal info dataframe.
@@ -388,53 +532,290 @@ def clean_meal_info_keepday0(
         - had events on the watch distribution date removed
         - had events more than 7 days after the distribution date removed
 
+    Each participant is cleaned independently, so this can be split across
+    processes; the result is identical to the serial one.
+
     :param meal_df: dataframe of meal info
     :param keep_catchups: whether to keep catchup markers and entries
     :param verbose: extra print information
+    :param n_workers: number of processes to clean with
+    :param shard_size: number of participants to send to a process at once.
+                       Defaults to splitting the participants evenly between the workers
 
     :returns: a cleaned copy of the dataframe
 
     """
-    retval = meal_df.copy()
+    return _clean(
+        meal_df,
+        n_workers=n_workers,
+        shard_size=shard_size,
+        first_day=1,
+        keep_catchups=keep_catchups,
+        verbose=verbose,
+    )
 
-    retval = retval.sort_index(inplace=False)
 
-    # Find early entries
-    retval = retval[retval["delta"].dt.days >= 0]
+def _store_dir(keep_catchups: bool) -> pathlib.Path:
+    """
+    Directory holding the store of cleaned entries
 
-    # Fine late entries
-    retval = retval[retval["delta"].dt.days <= 7]
+    Holds one parquet file per participant in entries/, the per-participant flags
+    and a manifest of the hashes of the raw rows they were made from. The sizes and
+    modification times of the raw files are kept too, to cheaply check whether
+    the store might be out of date
 
-    # Find duplicates
-    retval = retval[~duplicates(retval)]
+    """
+    return read._data_dir() / "cleaned_smartwatch" / f"keep_catchups={keep_catchups}"
 
-    # Optionally remove catchups
-    if not keep_catchups:
-        retval = remove_catchups(retval)
 
-    # Add Ramadan info
-    # Whether each entry was within Ramadan
-    retval["entry_in_ramadan"] = util.in_ramadan_2022(retval.index, verbose=verbose)
+def _source_stats() -> dict[str, list[int]]:
+    """
+    Size and modification time of each raw file the store of cleaned entries is made from
+
+    """
+    return {key: read._source_stat(key) for key in STORE_SOURCES}
+
 
-    # Whether the participants period was within Ramadan
-    ramadan_info = _ramadan_info(retval, verbose=verbose)
-
-    # Whether the participant's last positive entry was on day 7
-    last_entry = {
-        p_id: retval[
-            (retval["p_id"] == p_id)
-            & (retval["meal_type"].isin({"Meal", "Drink", "Snack", "No food/drink"}))
-        ]["delta"].dt.days.max()
-        for p_id in retval["p_id"].unique()
-    }
-    retval["early_stop"] = False
-    for pid in retval["p_id"].unique():
-        if last_entry[pid] < 7:
-            retval.loc[retval["p_id"] == pid, "early_stop"] = True
-
-    # Need to do this to preserve the index
-    retval["Datetime"] = retval.index
-    return retval.merge(ramadan_info, on="p_id").set_index("Datetime").sort_index()
-
-def cleaned_smartwatch_keepday0(*, keep_catchups: bool) -> pd.DataFrame:
-    return clean_meal_info_keepday0(read.all_meal_info(), keep_catchups=keep_catchups)
\ No newline at end of file
+def _participant_hashes(raw_meal_df: pd.DataFrame) -> dict[int, str]:
+    """
+    Content hash of each participant's raw smartwatch rows
+
+    Also includes the participant's watch distribution date, since the cleaning depends on it
+
+    :param raw_meal_df: smartwatch meal info, as returned by `read.raw_meal_info`
+    :returns: dict of p_id -> hex digest
+
+    """
+    row_hashes = pd.util.hash_pandas_object(raw_meal_df, index=False).values
+    distribution_dates = read.participant_info()["distribution_date"]
+
+    retval = {}
+    for p_id, rows in raw_meal_df.groupby("p_id").indices.items():
+        digest = hashlib.sha1(row_hashes[rows].tobytes())
+        digest.update(str(distribution_dates.get(p_id)).encode())
+        retval[int(p_id)] = digest.hexdigest()
+
+    return retval
+
+
+def refresh_cleaned_store(
+    *,
+    keep_catchups: bool,
+    force: bool = False,
+    n_workers: int = 1,
+    shard_size: int = None,
+) -> list[int]:
+    """
+    Update the on-disk store of cleaned entries, cleaning only the participants
+    whose raw rows are new or have changed since the last refresh
+
+    The store doesn't know about changes to the cleaning code - use `force` to
+    re-clean everyone after changing it.
+
+    :param keep_catchups: whether to keep catchup markers and entries
+    :param force: re-clean every participant
+    :param n_workers: number of processes to clean with
+    :param shard_size: number of participants to send to a process at once
+
+    :returns: the participants that were cleaned
+
+    """
+    store_dir = _store_dir(keep_catchups)
+    entries_dir = store_dir / "entries"
+    entries_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest_path = store_dir / "manifest.json"
+    flags_path = store_dir / "participant_flags.parquet"
+    manifest = {}
+    flags = pd.DataFrame(columns=PARTICIPANT_FLAGS, index=pd.Index([], name="p_id"))
+    if manifest_path.is_file() and flags_path.is_file() and not force:
+        with open(manifest_path, "r") as stream:
+            manifest = {int(k): v for k, v in json.load(stream).items()}
+        flags = pd.read_parquet(flags_path)
+
+    # Before reading the raw files, so that changes made while we're reading them
+    # get picked up next time
+    source_stats = _source_stats()
+
+    raw_meal_df = read.raw_meal_info()
+    hashes = _participant_hashes(raw_meal_df)
+
+    changed = [p_id for p_id, digest in hashes.items() if manifest.get(p_id) != digest]
+    removed = [p_id for p_id in manifest if p_id not in hashes]
+
+    for p_id in [*changed, *removed]:
+        (entries_dir / f"{p_id}.parquet").unlink(missing_ok=True)
+        manifest.pop(p_id, None)
+    flags = flags.drop(index=[*changed, *removed], errors="ignore")
+
+    if changed:
+        cleaned = clean_meal_info(
+            read.process_meal_info(raw_meal_df[raw_meal_df["p_id"].isin(changed)]),
+            keep_catchups=keep_catchups,
+            n_workers=n_workers,
+            shard_size=shard_size,
+        )
+        for p_id, group in cleaned.groupby("p_id"):
+            group.to_parquet(entries_dir / f"{p_id}.parquet")
+
+        flags = pd.concat(
+            [flags, cleaned.groupby("p_id")[PARTICIPANT_FLAGS].first()]
+        ).sort_index()
+
+    flags.astype(bool).to_parquet(flags_path)
+
+    # Participants with no entries left after cleaning don't get a file, but
+    # we still record that they're up to date
+    manifest.update({p_id: hashes[p_id] for p_id in changed})
+
+    # Write the manifest last so that an interrupted refresh gets redone
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as stream:
+        json.dump({str(k): v for k, v in manifest.items()}, stream)
+    os.replace(tmp_path, manifest_path)
+
+    with open(store_dir / "sources.json", "w") as stream:
+        json.dump(source_stats, stream)
+
+    return changed
+
+
+def _store_is_stale(keep_catchups: bool) -> bool:
+    """
+    Whether the raw files might have changed since the store was last refreshed
+
+    Only compares the files' sizes and modification times, so doesn't read them
+
+    """
+    store_dir = _store_dir(keep_catchups)
+    sources_path = store_dir / "sources.json"
+    if not (store_dir / "participant_flags.parquet").is_file():
+        return True
+    if not sources_path.is_file():
+        return True
+
+    with open(sources_path, "r") as stream:
+        return json.load(stream) != _source_stats()
+
+
+def participant_flags(*, keep_catchups: bool, refresh: bool = False) -> pd.DataFrame:
+    """
+    Per-participant flags found while cleaning: whether their entries were in Ramadan
+    and whether they stopped early
+
+    These are saved alongside the store of cleaned entries, so can be loaded without
+    reading the smartwatch CSV. The store is only refreshed if the raw files' sizes
+    or modification times have changed since it was last refreshed, or if asked.
+
+    :param keep_catchups: whether catchups were kept when cleaning
+    :param refresh: update the store first (see `refresh_cleaned_store`), even if
+                    the raw files look unchanged
+
+    :returns: dataframe of `PARTICIPANT_FLAGS` indexed by p_id; one row per participant
+              with cleaned entries
+
+    """
+    if refresh or _store_is_stale(keep_catchups):
+        refresh_cleaned_store(keep_catchups=keep_catchups)
+
+    return pd.read_parquet(_store_dir(keep_catchups) / "participant_flags.parquet")
+
+
+def _stored_cleaned_smartwatch(*, keep_catchups: bool) -> pd.DataFrame:
+    """
+    Read every participant's cleaned entries from the store
+
+    """
+    paths = sorted((_store_dir(keep_catchups) / "entries").glob("*.parquet"))
+
+    # No participants have any cleaned entries
+    if not paths:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name="Datetime"))
+
+    retval = _sort_entries(pd.concat([pd.read_parquet(path) for path in paths]))
+
+    # Missing categories come back from parquet as None, but the cleaning gives NaN
+    category = retval["catchup_category"]
+    retval["catchup_category"] = category.where(category.notna(), np.nan)
+
+    return retval
+
+
+def cleaned_smartwatch(
+    *,
+    keep_catchups: bool,
+    n_workers: int = 1,
+    shard_size: int = None,
+    incremental: bool = False,
+) -> pd.DataFrame:
+    """
+    Cleaned smartwatch entries
+
+    :param keep_catchups: whether to keep catchup markers and entries
+    :param n_workers: number of processes to clean with
+    :param shard_size: number of participants to send to a process at once
+    :param incremental: only clean participants that are new or have changed since
+                        the last call, reading the rest from a local store.
+                        See `refresh_cleaned_store`
+
+    :returns: dataframe of cleaned entries
+
+    """
+    if incremental:
+        refresh_cleaned_store(
+            keep_catchups=keep_catchups, n_workers=n_workers, shard_size=shard_size
+        )
+        return _stored_cleaned_smartwatch(keep_catchups=keep_catchups)
+
+    return clean_meal_info(
+        read.all_meal_info(),
+        keep_catchups=keep_catchups,
+        n_workers=n_workers,
+        shard_size=shard_size,
+    )
+
+
+def clean_meal_info_keepday0(
+    meal_df: pd.DataFrame,
+    *,
+    keep_catchups: bool,
+    verbose: bool = False,
+    n_workers: int = 1,
+    shard_size: int = None,
+) -> pd.DataFrame:
+    """
+    Clean the provided meal info dataframe.
+
+    Returns a dataframe of meal time info that has:
+        - had duplicates removed (as defined above)
+        - had events before the participant watch distribution date removed
+        - had events more than 7 days after the distribution date removed
+
+    :param meal_df: dataframe of meal info
+    :param keep_catchups: whether to keep catchup markers and entries
+    :param verbose: extra print information
+    :param n_workers: number of processes to clean with
+    :param shard_size: number of participants to send to a process at once
+
+    :returns: a cleaned copy of the dataframe
+
+    """
+    return _clean(
+        meal_df,
+        n_workers=n_workers,
+        shard_size=shard_size,
+        first_day=0,
+        keep_catchups=keep_catchups,
+        verbose=verbose,
+    )
+
+
+def cleaned_smartwatch_keepday0(
+    *, keep_catchups: bool, n_workers: int = 1, shard_size: int = None
+) -> pd.DataFrame:
+    return clean_meal_info_keepday0(
+        read.all_meal_info(),
+        keep_catchups=keep_catchups,
+        n_workers=n_workers,
+        shard_size=shard_size,
+    )
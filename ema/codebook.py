@@ -0,0 +1,197 @@
+"""
+Decode the numbered answers in the questionnaire/income data
+
+Each codebook is compiled once into a sorted array of answer codes and a
+categorical dtype; a column is then decoded with one `searchsorted` instead of
+a `.map` over every value. Decoded columns are categoricals, so are much
+smaller than columns of strings.
+
+"""
+import os
+import json
+import pathlib
+from functools import cache
+
+import numpy as np
+import pandas as pd
+
+from . import read
+
+
+class Codebook:
+    """
+    The answers to one question, compiled for decoding
+
+    The categories are the answer labels in order of their codes, so every
+    column decoded with the same codebook has the same integer codes
+
+    """
+
+    def __init__(self, answers: dict, question: str = None):
+        """
+        :param answers: dict of {answer code: answer label}
+        :param question: human readable question
+
+        """
+        codes = sorted(answers)
+        labels = [answers[code] for code in codes]
+
+        self.question = question
+        self.codes = np.array(codes, dtype=float)
+
+        # Some codes share a label, so the categories can be fewer than the codes
+        self.dtype = pd.CategoricalDtype(pd.unique(pd.Series(labels, dtype=object)))
+        self._label_codes = self.dtype.categories.get_indexer(labels)
+
+    def decode(self, values: pd.Series) -> pd.Series:
+        """
+        Turn answer codes into their labels
+
+        :param values: numeric series of answer codes
+        :returns: categorical series with the same index; NaN where the code
+                  isn't in the codebook
+
+        """
+        codes = np.asarray(values, dtype=float)
+        if not len(self.codes):
+            positions = np.full(len(codes), -1)
+        else:
+            # Out of range codes get clipped to an end, then don't match it
+            positions = np.searchsorted(self.codes, codes).clip(max=len(self.codes) - 1)
+            positions[self.codes[positions] != codes] = -1
+
+        categorical = pd.Categorical.from_codes(
+            np.where(positions == -1, -1, self._label_codes[positions]),
+            dtype=self.dtype,
+        )
+        return pd.Series(
+            categorical,
+            index=getattr(values, "index", None),
+            name=getattr(values, "name", None),
+        )
+
+
+def decode(frame: pd.DataFrame, codebooks: dict[str, Codebook]) -> pd.DataFrame:
+    """
+    Decode every column of a dataframe that has a codebook
+
+    :param frame: dataframe of answer codes, e.g. from `read.full_questionnaire`
+    :param codebooks: dict of {column name: codebook}
+
+    :returns: a copy of the dataframe with the decoded columns replaced by categoricals
+
+    """
+    return frame.assign(
+        **{
+            column: codebooks[column].decode(frame[column])
+            for column in frame
+            if column in codebooks
+        }
+    )
+
+
+@cache
+def questionnaire_codebooks() -> dict[str, Codebook]:
+    """
+    Codebooks for the questions in `read.questionnaire`
+
+    """
+    return {
+        "respondent_status": Codebook(read.qnaire_status_codebook()),
+        "respondent_sex": Codebook(read.qnaire_sex_codebook()),
+        "respondent_ethnicity": Codebook(read.qnaire_ethnicity_codebook()),
+    }
+
+
+@cache
+def income_codebooks() -> dict[str, Codebook]:
+    """
+    Codebooks for the questions in `read.income_data`
+
+    """
+    return {
+        column: Codebook(
+            {code: label for code, label in answers.items() if code != "q"},
+            question=answers["q"],
+        )
+        for column, answers in read.income_codebook().items()
+    }
+
+
+def _parse_full_codebook(sheet: pd.DataFrame) -> dict[str, dict]:
+    """
+    Find the answers to each question in the codebook spreadsheet
+
+    Each question has a row with its "Variable Name" and "Variable Label",
+    followed by a row for each of its answers with an "Answer Code" and
+    "Answer Label". Open ended questions have no answers, so are left out.
+
+    :param sheet: the spreadsheet, as returned by `read.full_codebook`
+    :returns: dict of {variable name: {"question": label, "codes": [...], "labels": [...]}}
+
+    """
+    is_question = sheet["Variable Name"].notna()
+
+    questions = sheet[is_question].drop_duplicates("Variable Name")
+    questions = questions.set_index("Variable Name")["Variable Label"]
+
+    answers = sheet[~is_question].assign(
+        variable=sheet["Variable Name"].ffill()[~is_question],
+        code=pd.to_numeric(sheet["Answer Code"], errors="coerce"),
+    )
+    answers = answers.dropna(subset=["variable", "code", "Answer Label"])
+
+    return {
+        variable: {
+            "question": str(questions[variable]),
+            "codes": rows["code"].tolist(),
+            "labels": rows["Answer Label"].tolist(),
+        }
+        for variable, rows in answers.groupby("variable", sort=False)
+    }
+
+
+def _full_codebook_cache_path() -> pathlib.Path:
+    """
+    Where the compiled full codebook is kept
+
+    """
+    return read._data_dir() / "full_codebook.json"
+
+
+@cache
+def full_codebooks() -> dict[str, Codebook]:
+    """
+    Codebooks for the questions in `read.full_questionnaire`
+
+    Parsing the spreadsheet is slow, so the parsed codebook is kept in data/;
+    it's re-parsed if the spreadsheet's size or modification time changes
+
+    """
+    stat = os.stat(read._seaco_path("qnaire_codebook"))
+    cache_path = _full_codebook_cache_path()
+
+    parsed = None
+    if cache_path.exists():
+        with open(cache_path, "r") as f:
+            stored = json.load(f)
+        if stored["size"] == stat.st_size and stored["mtime"] == stat.st_mtime_ns:
+            parsed = stored["codebooks"]
+
+    if parsed is None:
+        parsed = _parse_full_codebook(read.full_codebook())
+
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"size": stat.st_size, "mtime": stat.st_mtime_ns, "codebooks": parsed},
+                f,
+            )
+        os.replace(tmp_path, cache_path)
+
+    return {
+        variable: Codebook(
+            dict(zip(answers["codes"], answers["labels"])), question=answers["question"]
+        )
+        for variable, answers in parsed.items()
+    }
@@ -0,0 +1,282 @@
+"""
+Random access into AX6 .cwa files
+
+A .cwa file is a header followed by fixed-size 512-byte sectors, each holding
+a block of samples and the time of that block. Decoding the whole file to get
+one hour of data is slow (especially over the network), so here we build a
+small index of block start times once per file and use it to read only the
+sectors covering a time range.
+
+"""
+import os
+import pathlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+from openmovement.load import CwaData
+
+SECTOR_SIZE = 512
+
+# "AX" little-endian; marks a sector holding data
+_DATA_HEADER = 0x5841
+
+# The fields we need from each data sector to find its timestamp
+_SECTOR_DTYPE = np.dtype(
+    {
+        "names": [
+            "header",
+            "length",
+            "fractional",
+            "timestamp",
+            "rate",
+            "timestamp_offset",
+        ],
+        "formats": ["<u2", "<u2", "<u2", "<u4", "u1", "<i2"],
+        "offsets": [0, 2, 4, 14, 24, 26],
+        "itemsize": SECTOR_SIZE,
+    }
+)
+
+# Sample times are interpolated between block timestamps, which can be up to
+# around a second away from the start of their block; read this much extra
+# either side of a time range so the samples inside it get the right times
+_PADDING = pd.Timedelta(2, "s")
+
+# Read the file in chunks of this many sectors when building the index
+_CHUNK_SECTORS = 1 << 16
+
+
+def _data_offset(filepath: pathlib.Path) -> int:
+    """
+    Number of bytes before the first data sector
+
+    :param filepath: path to the CWA file
+    :returns: offset of the first data sector in bytes
+
+    """
+    with open(filepath, "rb") as f:
+        header = f.read(4)
+    assert header[:2] == b"MD", f"{filepath} is not a CWA file"
+
+    # Header length is stored without the 4 bytes of header ID + length
+    header_length = int.from_bytes(header[2:4], "little") + 4
+    return -(-header_length // SECTOR_SIZE) * SECTOR_SIZE
+
+
+def _block_times(sectors: np.ndarray) -> np.ndarray:
+    """
+    Time of the first sample in each data sector
+
+    Vectorised version of the timestamp logic in openmovement's parser
+
+    :param sectors: structured array of sectors with dtype `_SECTOR_DTYPE`
+    :returns: array of datetime64[ns]; NaT for sectors that don't hold data
+
+    """
+    packed = sectors["timestamp"].astype(np.int64)
+
+    # Packed as YYYYYYMM MMDDDDDh hhhhmmmm mmssssss, years since 2000
+    times = (
+        pd.to_datetime(
+            pd.DataFrame(
+                {
+                    "year": ((packed >> 26) & 0x3F) + 2000,
+                    "month": (packed >> 22) & 0x0F,
+                    "day": (packed >> 17) & 0x1F,
+                    "hour": (packed >> 12) & 0x1F,
+                    "minute": (packed >> 6) & 0x3F,
+                    "second": packed & 0x3F,
+                }
+            ),
+            errors="coerce",
+        )
+        .values.astype("datetime64[ns]")
+        .view(np.int64)
+    )
+
+    frequency = 3200 / (1 << (15 - (sectors["rate"].astype(np.int64) & 0x0F)))
+    offset = sectors["timestamp_offset"].astype(np.int64)
+
+    # If the top bit is set, the bottom 15 bits are a fractional part of a second
+    fractional = sectors["fractional"].astype(np.int64)
+    has_fraction = (fractional & 0x8000) != 0
+    fraction = np.where(has_fraction, (fractional & 0x7FFF) << 1, 0)
+    offset += (fraction * frequency.astype(np.int64)) >> 16
+
+    seconds = fraction / 65536 - offset / frequency
+    times += np.round(seconds * 1e9).astype(np.int64)
+
+    valid = (sectors["header"] == _DATA_HEADER) & (sectors["length"] == 508)
+    times[~valid] = np.datetime64("NaT").astype(np.int64)
+
+    return times.view("datetime64[ns]")
+
+
+def _index_path(filepath: pathlib.Path) -> pathlib.Path:
+    """
+    Where the index for a CWA file is kept
+
+    """
+    return filepath.with_name(f"{filepath.name}.idx.npz")
+
+
+def _build_index(filepath: pathlib.Path) -> dict:
+    """
+    Read the timestamp of every sector in a CWA file
+
+    :param filepath: path to the CWA file
+    :returns: dict of the data offset and block start times
+
+    """
+    data_offset = _data_offset(filepath)
+
+    times = []
+    with open(filepath, "rb") as f:
+        f.seek(data_offset)
+        while chunk := f.read(_CHUNK_SECTORS * SECTOR_SIZE):
+            n_sectors = len(chunk) // SECTOR_SIZE
+            sectors = np.frombuffer(chunk, dtype=_SECTOR_DTYPE, count=n_sectors)
+            times.append(_block_times(sectors))
+
+    return {
+        "data_offset": data_offset,
+        "times": np.concatenate(times) if times else np.array([], "datetime64[ns]"),
+    }
+
+
+def block_index(filepath: str) -> dict:
+    """
+    Index of the start time of every sector in a CWA file
+
+    Built the first time it is needed and stored alongside the CWA file as
+    `<filename>.idx.npz`; rebuilt if the CWA file's size or modification time
+    changes.
+
+    :param filepath: path to the CWA file
+    :returns: dict with keys "data_offset" (bytes before the first data sector)
+              and "times" (datetime64 array of block start times, NaT for
+              sectors that don't hold data)
+
+    """
+    filepath = pathlib.Path(filepath)
+    stat = filepath.stat()
+    index_path = _index_path(filepath)
+
+    if index_path.exists():
+        with np.load(index_path) as stored:
+            if stored["size"] == stat.st_size and stored["mtime"] == stat.st_mtime_ns:
+                return {
+                    "data_offset": int(stored["data_offset"]),
+                    "times": stored["times"],
+                }
+
+    index = _build_index(filepath)
+
+    # Write to a temporary file first so that an interrupted write can't leave
+    # a corrupt index behind
+    tmp_path = index_path.with_name(f"{index_path.name}.tmp.npz")
+    np.savez(
+        tmp_path,
+        size=stat.st_size,
+        mtime=stat.st_mtime_ns,
+        data_offset=index["data_offset"],
+        times=index["times"],
+    )
+    os.replace(tmp_path, index_path)
+
+    return index
+
+
+def sector_range(
+    times: np.ndarray, start: pd.Timestamp, end: pd.Timestamp
+) -> tuple[int, int]:
+    """
+    Which sectors hold samples between two times
+
+    :param times: block start times from `block_index`
+    :param start: start of the time range; None for the start of the recording
+    :param end: end of the time range; None for the end of the recording
+
+    :returns: (first, last) sector numbers, with `last` exclusive. Includes
+              some padding either side of the range, since sample times are
+              interpolated between neighbouring blocks. Always covers at
+              least one data sector, even if the range is outside the recording
+
+    """
+    if start is not None and end is not None:
+        assert start <= end, f"{start=} is after {end=}"
+
+    # Binary search over only the sectors that hold data
+    (valid,) = np.nonzero(~np.isnat(times))
+    assert len(valid), "No data sectors"
+    valid_times = times[valid]
+    assert np.all(np.diff(valid_times.view(np.int64)) >= 0), "Blocks out of order"
+
+    first = (
+        0
+        if start is None
+        else np.searchsorted(valid_times, np.datetime64(start - _PADDING)) - 1
+    )
+    last = (
+        len(valid)
+        if end is None
+        else np.searchsorted(valid_times, np.datetime64(end + _PADDING), side="right")
+    )
+
+    first = min(max(first, 0), len(valid) - 1)
+    last = max(min(last, len(valid)), first + 1)
+
+    return int(valid[first]), int(valid[last - 1]) + 1
+
+
+def read_time_range(
+    filepath: str,
+    start: pd.Timestamp,
+    end: pd.Timestamp,
+    **cwa_kw,
+) -> pd.DataFrame:
+    """
+    Decode the samples in a CWA file between two times
+
+    Only the header and the sectors covering the time range are read from the
+    file; these are copied to a local temporary file and decoded there.
+
+    :param filepath: path to the CWA file
+    :param start: start of the time range (inclusive); None for no lower limit
+    :param end: end of the time range (inclusive); None for no upper limit
+    :param cwa_kw: passed to `CwaData`, e.g. include_gyro=True
+
+    :returns: the samples between start and end, as returned by
+              `CwaData.get_samples`. Empty if there are none
+
+    """
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+    index = block_index(filepath)
+    first, last = sector_range(index["times"], start, end)
+
+    with open(filepath, "rb") as f:
+        header = f.read(index["data_offset"])
+        f.seek(index["data_offset"] + first * SECTOR_SIZE)
+        sectors = f.read((last - first) * SECTOR_SIZE)
+
+    # CwaData only reads from a file, so write the sectors we want to one
+    tmp = tempfile.NamedTemporaryFile(suffix=".cwa", delete=False)
+    try:
+        with tmp:
+            tmp.write(header)
+            tmp.write(sectors)
+        with CwaData(tmp.name, **cwa_kw) as cwa_data:
+            samples = cwa_data.get_samples()
+    finally:
+        os.remove(tmp.name)
+
+    time = samples.iloc[:, 0]
+    keep = np.ones(len(samples), dtype=bool)
+    if start is not None:
+        keep &= (start <= time).values
+    if end is not None:
+        keep &= (time <= end).values
+
+    return samples[keep].reset_index(drop=True)
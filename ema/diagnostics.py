@@ -0,0 +1,123 @@
+"""
+Things noticed about the data while reading and cleaning it, e.g. open-ended catch-ups
+
+Each event is logged to the "ema" logger as a record with a stage, participant,
+time and reason. Nothing is printed unless you ask for it: either collect the
+records into a table with
+
+    with diagnostics.collect() as collector:
+        meal_info = read.all_meal_info()
+    collector.table()
+
+or configure logging as usual, e.g. `logging.basicConfig(level=logging.INFO)`.
+
+Events logged in worker processes (e.g. when cleaning in parallel) aren't collected.
+
+"""
+import logging
+from contextlib import contextmanager
+
+import pandas as pd
+
+FIELDS = ("stage", "p_id", "time", "reason")
+
+logger = logging.getLogger("ema")
+
+# Stop python printing warnings if logging hasn't been configured
+logger.addHandler(logging.NullHandler())
+
+
+def enabled(level: int = logging.INFO) -> bool:
+    """
+    Whether events at this level are being recorded anywhere
+
+    Check this before doing any work just to describe an event
+
+    """
+    return logger.isEnabledFor(level)
+
+
+def record(
+    stage: str,
+    reason: str,
+    *,
+    p_id: int = None,
+    time: pd.Timestamp = None,
+    level: int = logging.INFO,
+    **log_kw,
+) -> None:
+    """
+    Record an event
+
+    :param stage: the function or step that noticed it, e.g. "flag_catchup_entries"
+    :param reason: what happened
+    :param p_id: participant it happened to, if any
+    :param time: time of the entry it happened at, if any
+    :param level: logging level
+    :param log_kw: passed to `logger.log`, e.g. stack_info=True
+
+    """
+    if not logger.isEnabledFor(level):
+        return
+
+    logger.log(
+        level,
+        "%s: %s (p_id=%s, time=%s)",
+        stage,
+        reason,
+        p_id,
+        time,
+        extra={"stage": stage, "p_id": p_id, "time": time, "reason": reason},
+        **log_kw,
+    )
+
+
+class Collector(logging.Handler):
+    """
+    Logging handler that keeps the events, so they can be looked at as a table
+
+    """
+
+    def __init__(self, level: int = logging.INFO):
+        super().__init__(level)
+        self.records = []
+
+    def emit(self, log_record: logging.LogRecord) -> None:
+        self.records.append(
+            (
+                log_record.levelname,
+                *(getattr(log_record, field, None) for field in FIELDS),
+            )
+        )
+
+    def table(self) -> pd.DataFrame:
+        """
+        The events collected so far
+
+        :returns: dataframe with columns level, stage, p_id, time, reason
+
+        """
+        return pd.DataFrame(self.records, columns=["level", *FIELDS])
+
+
+@contextmanager
+def collect(level: int = logging.INFO):
+    """
+    Collect the events recorded inside a `with` block
+
+    :param level: collect events at this level and above
+    :returns: context manager giving a `Collector`
+
+    """
+    collector = Collector(level)
+    old_level = logger.level
+
+    logger.addHandler(collector)
+    if logger.getEffectiveLevel() > level:
+        logger.setLevel(level)
+
+    try:
+        yield collector
+    finally:
+        logger.removeHandler(collector)
+        logger.setLevel(old_level)
@@ -0,0 +1,151 @@
+"""
+Local read-through cache for files on the RDSF network mount
+
+Files are copied to a local directory the first time they're read, then read
+from there as long as the original's size and modification time haven't
+changed. Once the cache is bigger than its size limit, the least recently
+used files are deleted.
+
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import pathlib
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Name of the file that records what's in a cache directory
+_MANIFEST = "manifest.json"
+
+# Held while reading/writing a manifest, so that background prefetches and
+# foreground reads don't step on each other
+_lock = threading.Lock()
+
+# Held while copying a file, so the same file isn't copied twice at once
+_copy_locks = defaultdict(threading.Lock)
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=2)
+
+
+def _read_manifest(cache_dir: pathlib.Path) -> dict:
+    """
+    Read the record of cached files
+
+    :returns: dict of {source path: {"local", "size", "mtime", "last_used"}}
+
+    """
+    try:
+        with open(cache_dir / _MANIFEST, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_manifest(cache_dir: pathlib.Path, manifest: dict) -> None:
+    """
+    Write the record of cached files via a temporary file
+
+    """
+    tmp_path = cache_dir / f"{_MANIFEST}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, cache_dir / _MANIFEST)
+
+
+def _evict(cache_dir: pathlib.Path, manifest: dict, max_bytes: int) -> None:
+    """
+    Delete the least recently used files until the cache fits in `max_bytes`
+
+    Modifies the manifest in place
+
+    """
+    total = sum(entry["size"] for entry in manifest.values())
+
+    for source in sorted(manifest, key=lambda source: manifest[source]["last_used"]):
+        if total <= max_bytes:
+            break
+
+        entry = manifest.pop(source)
+        (cache_dir / entry["local"]).unlink(missing_ok=True)
+        total -= entry["size"]
+
+
+def cached_path(
+    source: pathlib.Path, cache_dir: pathlib.Path, max_bytes: int
+) -> pathlib.Path:
+    """
+    Local copy of a file, copying it into the cache if needed
+
+    :param source: path to the file, e.g. on the RDSF mount
+    :param cache_dir: directory to keep the local copies in
+    :param max_bytes: maximum total size of the cache. Files bigger than this
+                      aren't cached
+
+    :returns: path to the local copy, or `source` itself if it's too big to cache
+
+    """
+    source = pathlib.Path(source)
+    key = str(source)
+
+    stat = source.stat()
+    if stat.st_size > max_bytes:
+        return source
+
+    with _lock:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        copy_lock = _copy_locks[key]
+
+    # Copy without holding the manifest lock, so other files can be read
+    # from the cache while this one is copied
+    with copy_lock:
+        with _lock:
+            entry = _read_manifest(cache_dir).get(key)
+
+        if (
+            entry is None
+            or entry["size"] != stat.st_size
+            or entry["mtime"] != stat.st_mtime_ns
+            or not (cache_dir / entry["local"]).exists()
+        ):
+            # Keep the original name so the file extension is the same, but
+            # prefix it with a hash of the whole path in case two have the same name
+            local = f"{hashlib.sha1(key.encode()).hexdigest()[:12]}_{source.name}"
+            tmp_path = cache_dir / f"{local}.tmp"
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, cache_dir / local)
+
+            entry = {"local": local, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+        with _lock:
+            # Re-read, in case another file was cached while we were copying
+            manifest = _read_manifest(cache_dir)
+
+            entry["last_used"] = time.time()
+            manifest[key] = entry
+
+            _evict(cache_dir, manifest, max_bytes)
+            _write_manifest(cache_dir, manifest)
+
+    return cache_dir / entry["local"]
+
+
+def prefetch(
+    sources: list[pathlib.Path], cache_dir: pathlib.Path, max_bytes: int
+) -> list[Future]:
+    """
+    Copy files into the cache in the background
+
+    :param sources: paths to the files
+    :param cache_dir: directory to keep the local copies in
+    :param max_bytes: maximum total size of the cache
+
+    :returns: a future for each file, holding its local path once copied
+
+    """
+    return [
+        _prefetch_executor.submit(cached_path, source, cache_dir, max_bytes)
+        for source in sources
+    ]
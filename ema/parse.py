@@ -5,7 +5,7 @@ Helper functions for parsing, cleaning data etc.
 import pandas as pd
 import numpy as np
 
-from . import util
+from . import util, diagnostics
 
 
 def extract_meals(
@@ -17,7 +17,7 @@ def extract_meals(
 
     :param meal_df: dataframe holding the smartwatch meal info, e.g. as returned from read.meal_info
     :param allowed_meal_types: the meal types to keep; e.g. {"Snack", "Meal"}
-    :param verbose: whether to print stuff to console
+    :param verbose: whether to also record what was discarded (see `diagnostics`)
 
     :returns: a slice of the original dataframe containing only the allowed meal types
     :raises: AssertionError if meal_type is not a column header in the meal_df
@@ -27,10 +27,16 @@ def extract_meals(
 
     keep = meal_df["meal_type"].isin(allowed_meal_types)
 
-    if verbose:
-        print(f"Discarding: {util.count_dict(meal_df[~keep].meal_type)}")
+    # Only count the meal types if something is going to see them
+    if verbose and diagnostics.enabled():
+        diagnostics.record(
+            "extract_meals", f"Discarding: {util.count_dict(meal_df[~keep].meal_type)}"
+        )
 
     retval = meal_df[keep]
-    print(f"Kept: {util.count_dict(retval.meal_type)}")
+    if diagnostics.enabled():
+        diagnostics.record(
+            "extract_meals", f"Kept: {util.count_dict(retval.meal_type)}"
+        )
 
     return retval
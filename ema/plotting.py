@@ -2,9 +2,13 @@
 Plotting tools
 
 """
+from functools import cache
+
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+from matplotlib.collections import LineCollection
 
 from . import analysis, util
 
@@ -48,12 +52,87 @@ def plot_integrals(
         axis.plot(times, data, **kwargs)
 
 
+@cache
+def _bin_edges(
+    min_time: pd.Timestamp, max_time: pd.Timestamp, granularity: str
+) -> pd.DatetimeIndex:
+    """
+    Regularly spaced bin edges between two times
+
+    Cached, since plots of the same data with the same granularity need the same edges
+
+    """
+    return pd.date_range(min_time, max_time, freq=granularity)
+
+
+def _sorted_meal_types(meal_types: np.ndarray) -> list[str]:
+    """
+    Put meal types in the order we want to plot them: "No ..." first, then
+    catchups, then the others
+
+    """
+    labels = [
+        *[l for l in meal_types if l.startswith("No ")],
+        *[l for l in meal_types if l.startswith("Catch-up")],
+        *meal_types,
+    ]
+    return list(dict.fromkeys(labels))  # Remove duplicates, preserve order
+
+
+def entry_time_counts(
+    meal_timing_df: pd.DataFrame, granularity: str = "1D"
+) -> tuple[pd.DatetimeIndex, list[str], np.ndarray]:
+    """
+    Count the entries of each meal type in each time bin
+
+    Bins are like `np.histogram` - each includes its left edge, and the last also
+    includes its right edge.
+    The counts can be reused between plots by passing them to `entry_time_hist`.
+
+    :param meal_timing_df: dataframe of smartwatch entries
+    :param granularity: bin granularity; "D", "H", etc. Or bin edges
+
+    :returns: the bin edges
+    :returns: the meal types, in plotting order
+    :returns: (meal types x bins) array of counts
+
+    """
+    bins = (
+        _bin_edges(meal_timing_df.index.min(), meal_timing_df.index.max(), granularity)
+        if isinstance(granularity, str)
+        else pd.DatetimeIndex(granularity)
+    )
+
+    type_codes, meal_types = pd.factorize(meal_timing_df["meal_type"])
+    labels = _sorted_meal_types(list(meal_types))
+
+    # Relabel the codes so that they're in plotting order
+    type_codes = np.array([labels.index(l) for l in meal_types], dtype=int)[type_codes]
+
+    # Find which bin each entry is in
+    edges = bins.values.astype("datetime64[ns]").view(np.int64)
+    times = meal_timing_df.index.values.astype("datetime64[ns]").view(np.int64)
+    bin_numbers = np.searchsorted(edges, times, side="right") - 1
+    bin_numbers[times == edges[-1]] = len(edges) - 2
+
+    n_bins = len(edges) - 1
+    in_range = (0 <= bin_numbers) & (bin_numbers < n_bins)
+
+    counts = np.bincount(
+        type_codes[in_range] * n_bins + bin_numbers[in_range],
+        minlength=len(labels) * n_bins,
+    ).reshape(len(labels), n_bins)
+
+    return bins, labels, counts
+
+
 def entry_time_hist(
     meal_timing_df: pd.DataFrame,
     *,
     cumulative: bool = False,
     granularity: str = "1D",
     fig_ax: tuple = None,
+    counts: tuple = None,
 ) -> tuple[plt.Figure, plt.Axes]:
     """
     Plot a histogram of the times of each type of entry in `meal_info`
@@ -62,35 +141,29 @@ def entry_time_hist(
     :param cumulative: whether to plot a cumulative histogram
     :param granularity: bin granularity; "D", "H", etc. Or bins
     :param fig_ax: optional figure and axis to plot on; creates a new figure if not specified
+    :param counts: optional precomputed counts from `entry_time_counts`; if specified,
+                   meal_timing_df and granularity aren't used
 
     :returns
 
     """
-    min_time, max_time = meal_timing_df.index.min(), meal_timing_df.index.max()
-
     fig, axis = plt.subplots() if fig_ax is None else fig_ax
-    bins = (
-        pd.date_range(min_time, max_time, freq=granularity)
-        if isinstance(granularity, str)
-        else granularity
-    )
 
-    # Sort the meal type labels
-    labels = meal_timing_df["meal_type"].unique()
-    labels = [
-        *[l for l in labels if l.startswith("No ")],
-        *[l for l in labels if l.startswith("Catch-up")],
-        *labels,
-    ]  # Put them in the desired order
-    labels = list(dict.fromkeys(labels))  # Remove duplicates, preserve order
-
-    # Get a list of Series giving the times of each meal type
-    data = [
-        meal_timing_df[meal_timing_df["meal_type"] == meal_type].index
-        for meal_type in labels
-    ]
+    bins, labels, counts = (
+        entry_time_counts(meal_timing_df, granularity) if counts is None else counts
+    )
+    if cumulative:
+        counts = np.cumsum(counts, axis=1)
+
+    # Stack the bars for each meal type on top of each other
+    lefts, widths = bins[:-1], bins[1:] - bins[:-1]
+    bottom = np.zeros(counts.shape[1], dtype=int)
+    for label, type_counts in zip(labels, counts):
+        axis.bar(
+            lefts, type_counts, width=widths, bottom=bottom, align="edge", label=label
+        )
+        bottom = bottom + type_counts
 
-    axis.hist(data, bins=bins, stacked=True, label=labels, cumulative=cumulative)
     axis.legend()
 
     # If fig and ax specified, we shouldn't take control of the formatting
@@ -104,13 +177,21 @@ def entry_time_hist(
 def participant_entries_per_day(
     meal_info: pd.DataFrame,
     fig_ax: tuple = None,
+    *,
+    rasterized: bool = False,
     **plot_kwargs: dict,
 ) -> tuple[plt.Figure, plt.Axes, dict[int, tuple[pd.Series, list]]]:
     """
     Plot a line graph showing how many entries each participant made per day
 
+    All the participants' lines are drawn as one LineCollection (and their markers
+    with one call to plot), which is much faster than plotting each separately
+
     :param meal_info: dataframe of smartwatch entries
     :param fig_ax: optional figure and axis to plot on; creates a new figure if not specified
+    :param rasterized: draw the lines and markers as a bitmap, even when saving to a
+                       vector format - keeps the file size down for lots of participants
+    :param plot_kwargs: color, alpha, marker, linestyle and linewidth for the lines
 
     :returns: figure and axis, and the dictionary of participant entries
 
@@ -131,8 +212,48 @@ def participant_entries_per_day(
         if "linewidth" not in plot_kwargs
         else plot_kwargs["linewidth"],
     }
-    for dates, entries in participant_entries.values():
-        axis.plot(dates, entries, **plot_kw)
+
+    # Pack every participant's points into one array, then split it into lines
+    lengths = [len(dates) for dates, _ in participant_entries.values()]
+    points = np.column_stack(
+        [
+            mdates.date2num(
+                np.concatenate([dates for dates, _ in participant_entries.values()])
+            )
+            if lengths
+            else [],
+            np.concatenate([entries for _, entries in participant_entries.values()])
+            if lengths
+            else [],
+        ]
+    )
+    lines = np.split(points, np.cumsum(lengths)[:-1])
+
+    if plot_kw["linestyle"] not in {"", " ", "None", "none"}:
+        axis.add_collection(
+            LineCollection(
+                lines,
+                colors=plot_kw["color"],
+                alpha=plot_kw["alpha"],
+                linestyles=plot_kw["linestyle"],
+                linewidths=plot_kw["linewidth"],
+                rasterized=rasterized,
+            )
+        )
+
+    if plot_kw["marker"] not in {None, "", " ", "None", "none"}:
+        axis.plot(
+            points[:, 0],
+            points[:, 1],
+            color=plot_kw["color"],
+            alpha=plot_kw["alpha"],
+            marker=plot_kw["marker"],
+            linestyle="none",
+            rasterized=rasterized,
+        )
+
+    axis.xaxis_date()
+    axis.autoscale_view()
 
     axis.set_ylabel("Number of entries per day")
 
@@ -6,6 +6,8 @@ Helpers for reading data from disk
 import os
 import yaml
 import shutil
+import hashlib
+import logging
 import pathlib
 from functools import cache
 
@@ -15,7 +17,7 @@ import pandas as pd
 from openmovement.load import CwaData
 from tqdm import tqdm
 
-from . import util, parse, clean
+from . import util, parse, clean, cwa, diagnostics, filecache
 
 
 def _data_dir() -> pathlib.Path:
@@ -52,40 +54,238 @@ def _conf() -> dict:
         return yaml.safe_load(stream)
 
 
+def _cache_settings() -> tuple[pathlib.Path, int]:
+    """
+    Where to cache files from RDSF, and how big the cache can get
+
+    :returns: the cache directory and the maximum size in bytes (0 if caching is off)
+
+    """
+    cache_dir = pathlib.Path(_userconf().get("cache_dir", "data/seaco_cache"))
+    if not cache_dir.is_absolute():
+        cache_dir = pathlib.Path(__file__).resolve().parents[1] / cache_dir
+
+    return cache_dir, int(_userconf().get("cache_size_gb", 10) * 1024**3)
+
+
+def _seaco_path(key: str) -> pathlib.Path:
+    """
+    Path to a file listed in config.yaml
+
+    The file lives on RDSF, but is copied to a local cache the first time it's
+    read (and again if it changes) - see `filecache`
+
+    :param key: the file's key in config.yaml, e.g. "meal_info"
+    :returns: path to the local copy, or to the file on RDSF if caching is off
+
+    """
+    path = pathlib.Path(_userconf()["seaco_dir"]) / _conf()[key]
+
+    cache_dir, max_bytes = _cache_settings()
+    if not max_bytes:
+        return path
+
+    return filecache.cached_path(path, cache_dir, max_bytes)
+
+
+def _source_stat(key: str) -> list[int]:
+    """
+    Size and modification time of a file listed in config.yaml, on RDSF
+
+    Much cheaper than reading the file, for checking whether it has changed
+
+    :param key: the file's key in config.yaml, e.g. "meal_info"
+    :returns: [size in bytes, modification time in ns]
+
+    """
+    stat = (pathlib.Path(_userconf()["seaco_dir"]) / _conf()[key]).stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def prefetch(*keys: str) -> None:
+    """
+    Start copying files listed in config.yaml to the local cache in the background
+
+    Call this at the start of a script with the files it'll need, so that they're
+    copied while it's busy doing other things
+
+    :param keys: the files' keys in config.yaml, e.g. "meal_info"
+
+    """
+    cache_dir, max_bytes = _cache_settings()
+    if not max_bytes:
+        return
+
+    filecache.prefetch(
+        [pathlib.Path(_userconf()["seaco_dir"]) / _conf()[key] for key in keys],
+        cache_dir,
+        max_bytes,
+    )
+
+
 @cache
 def _qnaire_df() -> pd.DataFrame:
     """
     Read the questionnaire dataframe
 
     """
-    path = pathlib.Path(_userconf()["seaco_dir"]) / _conf()["questionnaire"]
+    path = _seaco_path("questionnaire")
 
     return pd.read_csv(path)
 
 
+@cache
+def participant_info() -> pd.DataFrame:
+    """
+    Table of per-participant facts from the questionnaire and smartwatch feasibility data
+
+    Build this once instead of merging the questionnaire/feasibility dataframes onto
+    every dataframe that needs them; use `participant_facts` to join it onto entries.
+
+    Columns from the questionnaire:
+        respondent_status, smartwatchwilling, phyactq1, respondent_sex,
+        respondent_ethnicity, age_dob, smart1_10to17, smart1_7to9
+    Columns from the feasibility data:
+        watch_distributed (smartwatchwilling == 1 in the feasibility data),
+        distribution_date, collection_date
+    Derived columns:
+        in_questionnaire, in_feasibility, consented (respondent_status == 1)
+
+    :returns: dataframe indexed by residents_id
+
+    """
+    qnaire = _qnaire_df()[
+        [
+            "residents_id",
+            "respondent_status",
+            "smartwatchwilling",
+            "phyactq1",
+            "respondent_sex",
+            "respondent_ethnicity",
+            "age_dob",
+            "smart1_10to17",
+            "smart1_7to9",
+        ]
+    ]
+    qnaire = qnaire.astype({"residents_id": int}).set_index(
+        "residents_id", verify_integrity=True
+    )
+
+    feasibility = smartwatch_feasibility()
+    feasibility = pd.DataFrame(
+        {
+            "watch_distributed": (feasibility["smartwatchwilling"] == 1).values,
+            "distribution_date": feasibility["actualdateofdistribution1st"].values,
+            "collection_date": feasibility["collectiondate_actual"].values,
+        },
+        index=pd.Index(feasibility["residents_id"].astype(int), name="residents_id"),
+    )
+    assert feasibility.index.is_unique, "Duplicate residents_id in feasibility data"
+
+    retval = pd.concat([qnaire, feasibility], axis=1)
+
+    retval["in_questionnaire"] = retval.index.isin(qnaire.index)
+    retval["in_feasibility"] = retval.index.isin(feasibility.index)
+    retval["consented"] = retval["respondent_status"] == 1
+    retval["watch_distributed"] = retval["watch_distributed"].fillna(False).astype(bool)
+
+    return retval
+
+
+class ParticipantRegistry:
+    """
+    Sorted arrays of the IDs of the participants in each group, e.g. who consented
+
+    Built once from `participant_info`, so that finding a group or checking
+    whether participants are in it is a binary search instead of a filter over
+    the whole questionnaire. Combine groups with e.g. `np.intersect1d`.
+
+    """
+
+    def __init__(self, info: pd.DataFrame):
+        """
+        :param info: dataframe as returned by `participant_info`
+
+        """
+        ids = info.index.values.astype(np.int64)
+
+        def group(mask: pd.Series) -> np.ndarray:
+            return np.sort(ids[mask.values])
+
+        self.all = np.sort(ids)
+        self.in_questionnaire = group(info["in_questionnaire"])
+        self.in_feasibility = group(info["in_feasibility"])
+        self.consented = group(info["consented"])
+        self.smartwatch_willing = group(info["smartwatchwilling"] == 1)
+        self.smartwatch_unwilling = group(info["smartwatchwilling"] == 2)
+        self.no_collection_date = group(
+            info["in_feasibility"] & info["collection_date"].isnull()
+        )
+
+    @staticmethod
+    def contains(group: np.ndarray, participant_ids) -> np.ndarray:
+        """
+        Whether each participant is in a group
+
+        :param group: sorted array of IDs, e.g. `registry.consented`
+        :param participant_ids: a participant ID or array-like of them
+
+        :returns: boolean array the same shape as `participant_ids`
+
+        """
+        participant_ids = np.asarray(participant_ids, dtype=np.int64)
+        if not len(group):
+            return np.zeros(participant_ids.shape, dtype=bool)
+
+        positions = np.searchsorted(group, participant_ids).clip(max=len(group) - 1)
+        return group[positions] == participant_ids
+
+
+@cache
+def participant_registry() -> ParticipantRegistry:
+    """
+    The groups of participants in `participant_info`
+
+    """
+    return ParticipantRegistry(participant_info())
+
+
+def participant_facts(
+    participant_ids: pd.Series, columns: list[str], *, consented_only: bool = False
+) -> pd.DataFrame:
+    """
+    Look up per-participant facts for every row of a series of participant IDs
+
+    :param participant_ids: series of participant IDs, e.g. the p_id column of the entries df
+    :param columns: columns of `participant_info()` to look up
+    :param consented_only: set the facts to NaN for participants who didn't consent
+
+    :returns: dataframe of the requested columns with the same index as `participant_ids`
+
+    """
+    table = participant_info()[columns]
+    if consented_only:
+        table = table.where(participant_info()["consented"], axis=0)
+
+    return util.broadcast(table, participant_ids)
+
+
 def consented(residents_id: str) -> bool:
     """
     Whether a participant consented, based on the questionnaire answer
 
     """
-    # Read in the file of questionnaire information
-    qnaire_responses = _qnaire_df()
+    registry = participant_registry()
 
     r_id = int(residents_id)
 
     # Check that this value is in the df
-    if r_id not in qnaire_responses["residents_id"].values:
+    if not registry.contains(registry.in_questionnaire, r_id):
         raise ValueError(f"{residents_id} not found in questionnaire responses")
 
     # Check that the participant consented
     # i.e. that the status is 1
-    # im tired so this is bad
-    return (
-        qnaire_responses.loc[
-            qnaire_responses["residents_id"] == r_id, "respondent_status"
-        ].values
-        == [1]
-    ).all()
+    return bool(registry.contains(registry.consented, r_id))
 
 
 def accel_filepath(
@@ -123,7 +323,7 @@ def raw_meal_info() -> pd.DataFrame:
     Meal info exactly as it appears in the CSV
 
     """
-    path = pathlib.Path(_userconf()["seaco_dir"]) / _conf()["meal_info"]
+    path = _seaco_path("meal_info")
     return pd.read_csv(path)
 
 
@@ -132,21 +332,22 @@ def _datetime(meal_info: pd.DataFrame) -> pd.Series:
     Get a series representing the timestamp
 
     """
-    return pd.to_datetime(
-        meal_info["date"].map(str) + meal_info["timestamp"], format=r"%d%b%Y%H:%M:%S"
+    return util.combine_date_time(
+        meal_info["date"], meal_info["timestamp"], date_format=r"%d%b%Y"
     )
 
 
-@cache
-def all_meal_info(*, verbose=False) -> pd.DataFrame:
+def process_meal_info(raw_meal_df: pd.DataFrame) -> pd.DataFrame:
     """
-    Get smartwatch meal info from the smartwatch data; sorted by entry timestamp
+    Turn rows of the raw smartwatch CSV into the dataframe returned by `all_meal_info`
 
-    :param verbose: extra print output
+    Works on any subset of whole participants' rows
+
+    :param raw_meal_df: rows of the smartwatch meal info, as returned by `raw_meal_info`
     :returns: dataframe where the date and timestamp are combined into a single column and set as the index
 
     """
-    retval = raw_meal_info()
+    retval = raw_meal_df.copy()
 
     # Find a series representing the timestamp
     retval["Datetime"] = _datetime(retval)
@@ -161,8 +362,7 @@ def all_meal_info(*, verbose=False) -> pd.DataFrame:
     retval = retval.drop(["date", "timestamp"], axis=1)
 
     # Add catchup info
-    retval = clean.flag_catchups(retval)
-    retval = clean.flag_catchup_entries(retval)
+    retval = clean.flag_participant_catchups(retval)
 
     # Remove incorrect Ramadan flags
     retval = retval[[col for col in retval if "ramadanflag" not in col]]
@@ -173,6 +373,18 @@ def all_meal_info(*, verbose=False) -> pd.DataFrame:
     return retval
 
 
+@cache
+def all_meal_info(*, verbose=False) -> pd.DataFrame:
+    """
+    Get smartwatch meal info from the smartwatch data; sorted by entry timestamp
+
+    :param verbose: extra print output
+    :returns: dataframe where the date and timestamp are combined into a single column and set as the index
+
+    """
+    return process_meal_info(raw_meal_info())
+
+
 def meal_info(participant_id: str) -> pd.DataFrame:
     """
     Get smartwatch meal info for a single participant from the smartwatch data
@@ -187,21 +399,31 @@ def meal_info(participant_id: str) -> pd.DataFrame:
     return all_meals[all_meals["p_id"] == p_id]
 
 
-def accel_info(filepath: str) -> pd.DataFrame:
+def accel_info(
+    filepath: str, start: pd.Timestamp = None, end: pd.Timestamp = None
+) -> pd.DataFrame:
     """
     Get accelerometer data from a CWA file
 
     This file should be an AX6 database that includes accelerometry and
     gyroscopic data.
     These files are Big (and accessed over the network if using RDSF drive),
-    which means this function might be slow
+    which means this function might be slow - if you only need some of the
+    data, pass start and end so that only the right part of the file is read
 
     :param filepath: path to the CWA file
+    :param start: only read data from this time onwards
+    :param end: only read data up to this time
     :returns: the accelerometer, gyroscope and time data
 
     """
-    with CwaData(filepath, include_accel=True, include_gyro=True) as cwa_data:
-        retval = cwa_data.get_samples()
+    if start is None and end is None:
+        with CwaData(filepath, include_accel=True, include_gyro=True) as cwa_data:
+            retval = cwa_data.get_samples()
+    else:
+        retval = cwa.read_time_range(
+            filepath, start, end, include_accel=True, include_gyro=True
+        )
 
     retval.set_index("time", inplace=True, verify_integrity=False)
 
@@ -247,26 +469,124 @@ def get_participant_meal(
     :returns: a dataframe holding the accelerometer information for the hour. Uses time as the index
 
     """
-    # Get the whole dataframe
-    samples = accel_info(str(accel_filepath(device_id, recording_id, participant_id)))
-
-    # Slice the right meal
+    # Find the right meal
     # TODO refactor this cus its bad, i cba rn
     meal_df = meal_info(participant_id)
     allowed_meal_types = {"Snack", "Drink", "Meal", "No food/drink"}
     meal_df = parse.extract_meals(meal_df, allowed_meal_types, verbose=True)
 
-    # Find meal times
-    meal_times = meal_df["date"].map(str) + meal_df["timestamp"]
-
     # Find an hour slot before each meal
-    ends = pd.to_datetime(meal_times, format=r"%d%b%Y%H:%M:%S")
+    # The meal times were already parsed (by _datetime) into the index
+    ends = meal_df.index.to_series()
     starts = ends - pd.Timedelta(1, "hour")
 
     start, end = starts.iloc[meal_no], ends.iloc[meal_no]
 
-    # Copy so the original df doesn't have to be held in memory
-    return samples[start:end].copy()
+    # Only read the part of the file covering this hour
+    return accel_info(
+        str(accel_filepath(device_id, recording_id, participant_id)), start, end
+    )
+
+
+def _converted_accel_dir() -> pathlib.Path:
+    """
+    Directory where decoded accelerometer data is stored
+
+    """
+    return _data_dir() / "accel"
+
+
+def cwa_files() -> pd.DataFrame:
+    """
+    All the accelerometer files in the data/ directory
+
+    Files are named <device_id>_<recording_id>-<participant_id>.cwa; any .cwa
+    files not named like this are ignored
+
+    :returns: dataframe with columns device_id, recording_id, p_id and path
+
+    """
+    paths = pd.Series(sorted(_data_dir().glob("*.cwa")), dtype=object)
+
+    retval = (
+        paths.map(lambda path: path.name)
+        .str.extract(
+            r"^(?P<device_id>\d{7})_(?P<recording_id>\d{10})-(?P<p_id>\d+)\.cwa$"
+        )
+        .assign(path=paths)
+        .dropna()
+    )
+    retval["p_id"] = retval["p_id"].astype(int)
+
+    return retval.reset_index(drop=True)
+
+
+def converted_accel_path(cwa_path: pathlib.Path) -> pathlib.Path:
+    """
+    Where the decoded data from a CWA file is stored
+
+    :param cwa_path: path to the CWA file
+    :returns: path to the parquet file
+
+    """
+    return _converted_accel_dir() / f"{pathlib.Path(cwa_path).stem}.parquet"
+
+
+def is_converted(cwa_path: pathlib.Path) -> bool:
+    """
+    Whether a CWA file has been decoded since it was last modified
+
+    """
+    out_path = converted_accel_path(cwa_path)
+    return (
+        out_path.exists()
+        and out_path.stat().st_mtime_ns >= pathlib.Path(cwa_path).stat().st_mtime_ns
+    )
+
+
+def convert_accel(cwa_path: pathlib.Path) -> int:
+    """
+    Decode a CWA file and store the samples locally as parquet
+
+    Samples are stored as float32, which is plenty for the device's 16-bit
+    readings and halves the size of the file. The file is written to a temporary
+    path first, so an interrupted conversion doesn't leave a partial file behind.
+
+    :param cwa_path: path to the CWA file
+    :returns: the number of samples written
+
+    """
+    samples = accel_info(str(cwa_path)).astype(np.float32)
+
+    out_path = converted_accel_path(cwa_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = out_path.with_suffix(".tmp")
+    samples.to_parquet(tmp_path)
+    os.replace(tmp_path, out_path)
+
+    return len(samples)
+
+
+def converted_accel_info(
+    cwa_path: pathlib.Path, start: pd.Timestamp = None, end: pd.Timestamp = None
+) -> pd.DataFrame:
+    """
+    Get accelerometer data that was stored by `convert_accel`
+
+    :param cwa_path: path to the original CWA file
+    :param start: only read data from this time onwards
+    :param end: only read data up to this time
+    :returns: the accelerometer, gyroscope and time data, like `accel_info`
+
+    """
+    filters = []
+    if start is not None:
+        filters.append(("time", ">=", pd.Timestamp(start)))
+    if end is not None:
+        filters.append(("time", "<=", pd.Timestamp(end)))
+
+    return pd.read_parquet(converted_accel_path(cwa_path), filters=filters or None)
 
 
 @cache
@@ -281,7 +601,7 @@ def income_data() -> pd.DataFrame:
     :returns: dataframe holding survey responses
 
     """
-    path = pathlib.Path(_userconf()["seaco_dir"]) / _conf()["income_info"]
+    path = _seaco_path("income_info")
 
     return pd.read_csv(path)
 
@@ -399,7 +719,7 @@ def smartwatch_feasibility() -> pd.DataFrame:
     Get a dataframe of smartwatch feasibility data
 
     """
-    path = pathlib.Path(_userconf()["seaco_dir"]) / _conf()["feasibility_info"]
+    path = _seaco_path("feasibility_info")
     return pd.read_stata(path)
 
 
@@ -409,7 +729,7 @@ def full_questionnaire() -> pd.DataFrame:
     Get a dataframe of the full questionnaire data
 
     """
-    path = pathlib.Path(_userconf()["seaco_dir"]) / _conf()["full_questionnaire"]
+    path = _seaco_path("full_questionnaire")
     return pd.read_stata(path)
 
 
@@ -419,7 +739,7 @@ def full_codebook() -> pd.DataFrame:
     Get a dataframe of the full questionnaire codebook
 
     """
-    path = pathlib.Path(_userconf()["seaco_dir"]) / _conf()["qnaire_codebook"]
+    path = _seaco_path("qnaire_codebook")
     return pd.read_excel(path, sheet_name="Sheet1")
 
 
@@ -446,26 +766,22 @@ def no_collection_date(participant_ids: pd.Series) -> set:
     :returns: set of participants for whom no collection date was given
 
     """
-    feasibility_info = smartwatch_feasibility()
+    registry = participant_registry()
+    participant_ids = np.unique(np.asarray(participant_ids, dtype=np.int64))
 
     # Check none of the provided participant IDs aren't in the feasibility info
-    assert participant_ids.isin(
-        feasibility_info["residents_id"]
+    assert registry.contains(
+        registry.in_feasibility, participant_ids
     ).all(), "Provided participant ID not in the list of possible residents IDs"
 
-    # Slice the feasibility info to only include the participants we're interested in
-    feasibility_info = feasibility_info[
-        feasibility_info["residents_id"].isin(participant_ids)
-    ]
-
     # Could check that for all the provided participants, if collection date is not provided
     # then neither watch or AX collection date are provided either
 
     # Check whether the collection date is null for each participant
     return set(
-        feasibility_info["residents_id"][
-            pd.isnull(feasibility_info["collectiondate_actual"])
-        ]
+        np.intersect1d(
+            participant_ids, registry.no_collection_date, assume_unique=True
+        ).tolist()
     )
 
 
@@ -474,30 +790,19 @@ def add_timedelta(meal_info: pd.DataFrame) -> pd.DataFrame:
     Add a column showing the delta between watch distribution date and entry date
     to a dataframe
 
-    Also adds Datetime, residents_id column
+    :param meal_info: dataframe indexed by datetime, with a "p_id" column
+    :returns: a copy of the dataframe with a "delta" column added
 
     """
-    feasibility_info = smartwatch_feasibility()
-
-    # We only care about ones who consented to the smartwatch study
-    feasibility_info = feasibility_info[feasibility_info["smartwatchwilling"] == 1]
-    feasibility_info = feasibility_info[["residents_id", "actualdateofdistribution1st"]]
-
-    # Join dataframes
-    meal_info = (
-        meal_info.reset_index()
-        .merge(feasibility_info, left_on="p_id", right_on="residents_id", how="left")
-        .set_index(meal_info.index)
-    )
-
-    meal_info["delta"] = (
-        meal_info.index.to_series() - meal_info["actualdateofdistribution1st"]
+    info = participant_facts(
+        meal_info["p_id"], ["watch_distributed", "distribution_date"]
     )
 
-    assert (meal_info["residents_id"] == meal_info["p_id"]).all()
+    # We only care about ones who consented to the smartwatch study
+    assert (info["watch_distributed"] == True).all()
 
-    return meal_info.drop(
-        columns=["Datetime", "residents_id", "actualdateofdistribution1st"]
+    return meal_info.assign(
+        delta=meal_info.index - pd.DatetimeIndex(info["distribution_date"])
     )
 
 
@@ -512,23 +817,21 @@ def n_days_in_school(*, subset: str = None) -> dict:
     """
     assert subset in {None, "smartwatch", "not smartwatch"}
 
-    feasibility_df = _qnaire_df()
+    registry = participant_registry()
 
     # Only the respondents who consented
-    feasibility_df = feasibility_df[feasibility_df["respondent_status"] == 1]
+    keep = registry.consented
 
     if subset is None:
-        keep = ...
+        pass
     elif subset == "smartwatch":
-        keep = feasibility_df["smartwatchwilling"] == 1
+        keep = np.intersect1d(keep, registry.smartwatch_willing, assume_unique=True)
     elif subset == "not smartwatch":
-        keep = feasibility_df["smartwatchwilling"] == 2
+        keep = np.intersect1d(keep, registry.smartwatch_unwilling, assume_unique=True)
     else:
         raise ValueError
 
-    return dict(
-        zip(feasibility_df["residents_id"][keep], feasibility_df["phyactq1"][keep])
-    )
+    return participant_info()["phyactq1"].reindex(keep).to_dict()
 
 
 def ax6_summary():
@@ -536,9 +839,7 @@ def ax6_summary():
     Cleaned summary data for AX6 accelerometers
 
     """
-    return pd.read_stata(
-        pathlib.Path(_userconf()["seaco_dir"]) / _conf()["ax6_summary"]
-    )
+    return pd.read_stata(_seaco_path("ax6_summary"))
 
 
 def ax6_day_summary(*, part: int):
@@ -548,9 +849,7 @@ def ax6_day_summary(*, part: int):
     """
     assert part in {2, 5}
 
-    return pd.read_csv(
-        pathlib.Path(_userconf()["seaco_dir"]) / _conf()[f"ax6_day_summary_pt{part}"]
-    )
+    return pd.read_csv(_seaco_path(f"ax6_day_summary_pt{part}"))
 
 
 def ax6_person_summary(*, part: int):
@@ -560,9 +859,7 @@ def ax6_person_summary(*, part: int):
     """
     assert part in {2, 5}
 
-    return pd.read_csv(
-        pathlib.Path(_userconf()["seaco_dir"]) / _conf()[f"ax6_person_summary_pt{part}"]
-    )
+    return pd.read_csv(_seaco_path(f"ax6_person_summary_pt{part}"))
 
 
 def ax6_data_quality():
@@ -570,9 +867,27 @@ def ax6_data_quality():
     Data quality report
 
     """
-    return pd.read_csv(
-        pathlib.Path(_userconf()["seaco_dir"]) / _conf()["ax6_data_quality"]
-    )
+    return pd.read_csv(_seaco_path("ax6_data_quality"))
+
+
+def _battery_dir() -> pathlib.Path:
+    """
+    Local directory holding copies of the smartwatch databases
+
+    """
+    return (_data_dir() / "battery_dbs").resolve()
+
+
+def _smartwatch_db_files() -> list[pathlib.Path]:
+    """
+    The smartwatch databases on the RDSF
+
+    """
+    dirname = pathlib.Path(_userconf()["seaco_dir"]) / _conf()["smartwatch_dbs_dir"]
+    assert dirname.exists()
+
+    # Recurse into all "Week X" directories, extracting all .db files
+    return [file for file in dirname.glob("Week*/**/*.db")]
 
 
 def copy_battery_files():
@@ -582,16 +897,12 @@ def copy_battery_files():
 
     """
     # Create an output file directory
-    battery_dir = (pathlib.Path(__file__).parents[1] / "data" / "battery_dbs").resolve()
+    battery_dir = _battery_dir()
     if not battery_dir.is_dir():
         battery_dir.mkdir(parents=True)
 
     # Find all the files
-    dirname = pathlib.Path(_userconf()["seaco_dir"]) / _conf()["smartwatch_dbs_dir"]
-    assert dirname.exists()
-
-    # Recurse into all "Week X" directories, extracting all .db files
-    source_files = [file for file in dirname.glob("Week*/**/*.db")]
+    source_files = _smartwatch_db_files()
     dest_files = [os.path.join(battery_dir, file.name) for file in source_files]
 
     # Check that they don't all exist
@@ -603,110 +914,349 @@ def copy_battery_files():
             shutil.copyfile(source, dest)
 
 
-def _charge_and_discharges(battery_df: pd.DataFrame) -> tuple[dict, dict]:
+def _event_store_path() -> pathlib.Path:
     """
-    Number of charge/discharge periods per participant
+    SQLite database holding every participant's smartwatch events
 
     """
-    charges = {}
-    de_charges = {}
-    for p_id, group in battery_df.groupby("p_id"):
-        assert group["delta"].is_monotonic_increasing
+    return _data_dir() / "smartwatch_events.db"
 
-        # Find the sign for the battery level diff
-        diff_sign = (
-            np.sign(group["battery_lvl"].diff())
-            .replace(0, pd.NA)
-            .infer_objects(copy=False)
-        )
 
-        # Create a new series where the sign changes, ignoring zero differences
-        sign_change = (diff_sign.diff().ne(0) & diff_sign.ne(0)).cumsum()
+def _decode_events(event_df: pd.DataFrame, p_id: int) -> pd.DataFrame:
+    """
+    Convert rows from a smartwatch database's Event table to rows of the event store
+
+    """
+    retval = pd.DataFrame(
+        {
+            "p_id": p_id,
+            "Datetime": util.combine_date_time(
+                event_df["eventdate"], event_df["eventtime"], date_format="%Y-%m-%d"
+            )
+            .values.astype("datetime64[s]")
+            .astype(np.int64),
+            # The type of event is the description without its trailing value
+            # e.g. "Battery level 85%" -> "Battery level"
+            "event_type": event_df["eventdesc"].str.replace(
+                r"\s*-?\d+%?$", "", regex=True
+            ),
+            "eventdesc": event_df["eventdesc"],
+            "battery_lvl": pd.NA,
+        },
+        index=event_df.index,
+    )
 
-        # Count the number of charge and de-charge periods
-        charges[p_id] = (diff_sign > 0).groupby(sign_change).sum().astype(bool).sum()
-        de_charges[p_id] = (diff_sign < 0).groupby(sign_change).sum().astype(bool).sum()
+    # Battery level rows start with B
+    battery = event_df["eventdesc"].str.startswith("B")
+    retval.loc[battery, "battery_lvl"] = (
+        event_df.loc[battery, "eventdesc"].str.split(" ").str[-1].str[:-1].astype(int)
+    )
 
-    return charges, de_charges
+    return retval
 
 
-def battery_lvl_df() -> pd.DataFrame:
+def update_event_store() -> list[pathlib.Path]:
     """
-    Dataframe of battery level stuff
+    Copy the Event table from every local smartwatch database (see `copy_battery_files`)
+    into a single SQLite store, indexed by participant and time
 
-    Removes battery level with deltas below 0 and 7
+    Only databases that are new, or whose size or modification time have changed,
+    are read. Events from databases that have been deleted are removed from the store.
+    Databases that can't be read are remembered, so they aren't tried again
+    until their contents change; they are only hashed to check this if their size
+    or modification time changes.
+
+    :returns: the databases that were ingested
 
     """
-    battery_dir = (pathlib.Path(__file__).parents[1] / "data" / "battery_dbs").resolve()
-    dirname = pathlib.Path(_userconf()["seaco_dir"]) / _conf()["smartwatch_dbs_dir"]
-    source_files = [file for file in dirname.glob("Week*/**/*.db")]
-    dest_files = [os.path.join(battery_dir, file.name) for file in source_files]
-    dfs = []
+    conn = sqlite3.connect(_event_store_path())
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS events "
+        "(p_id INTEGER, Datetime INTEGER, event_type TEXT, eventdesc TEXT, "
+        "battery_lvl INTEGER, source TEXT)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS events_p_id_datetime ON events (p_id, Datetime)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sources "
+        "(name TEXT PRIMARY KEY, size INTEGER, mtime REAL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS failed_sources "
+        "(name TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT, error TEXT)"
+    )
+    ingested = {
+        name: (size, mtime)
+        for name, size, mtime in conn.execute("SELECT * FROM sources")
+    }
+    failed = {
+        name: (size, mtime, sha1)
+        for name, size, mtime, sha1 in conn.execute(
+            "SELECT name, size, mtime, sha1 FROM failed_sources"
+        )
+    }
 
-    for path in tqdm(dest_files):
+    local_files = sorted(_battery_dir().glob("*.db"))
+
+    # Remove the events from databases that no longer exist
+    local_names = {path.name for path in local_files}
+    with conn:
+        for name in ingested.keys() - local_names:
+            conn.execute("DELETE FROM events WHERE source = ?", (name,))
+            conn.execute("DELETE FROM sources WHERE name = ?", (name,))
+        for name in failed.keys() - local_names:
+            conn.execute("DELETE FROM failed_sources WHERE name = ?", (name,))
+
+    new_files = []
+    for path in local_files:
+        stat = (path.stat().st_size, path.stat().st_mtime)
+        if ingested.get(path.name) == stat:
+            continue
+
+        # Skip databases we already know we can't read
+        if path.name in failed:
+            if failed[path.name][:2] == stat:
+                continue
+
+            # It's been touched (e.g. copied again) - only retry if it's different
+            digest = hashlib.sha1(path.read_bytes()).hexdigest()
+            if digest == failed[path.name][2]:
+                with conn:
+                    conn.execute(
+                        "UPDATE failed_sources SET size = ?, mtime = ? WHERE name = ?",
+                        (*stat, path.name),
+                    )
+                continue
+
+        new_files.append(path)
+
+    retval = []
+    for path in tqdm(new_files):
         # Get the p_id from the path
-        path = pathlib.Path(path)
-        p_id = path.name.split("_")[1]
+        p_id = int(path.name.split("_")[1])
 
         # Open the db
-        conn = sqlite3.connect(path, uri=True)
-
-        # Get the battery level
+        source_conn = sqlite3.connect(path, uri=True)
         try:
-            df = pd.read_sql_query("SELECT * FROM Event;", conn)
+            event_df = pd.read_sql_query("SELECT * FROM Event;", source_conn)
 
         except pd.io.sql.DatabaseError as e:
-            print(f"{path} failed with {e}")
+            diagnostics.record(
+                "update_event_store",
+                f"could not read {path.name}: {e}",
+                p_id=p_id,
+                level=logging.WARNING,
+            )
+
+            # The old events are out of date now that the database has changed
+            with conn:
+                conn.execute("DELETE FROM events WHERE source = ?", (path.name,))
+                conn.execute("DELETE FROM sources WHERE name = ?", (path.name,))
+                conn.execute(
+                    "INSERT OR REPLACE INTO failed_sources VALUES (?, ?, ?, ?, ?)",
+                    (
+                        path.name,
+                        path.stat().st_size,
+                        path.stat().st_mtime,
+                        hashlib.sha1(path.read_bytes()).hexdigest(),
+                        str(e),
+                    ),
+                )
             continue
 
-        # Only keep battery level rows
-        df = df[df["eventdesc"].str.startswith("B")]
+        finally:
+            source_conn.close()
+
+        with conn:
+            conn.execute("DELETE FROM events WHERE source = ?", (path.name,))
+            conn.execute("DELETE FROM failed_sources WHERE name = ?", (path.name,))
+            _decode_events(event_df, p_id).assign(source=path.name).to_sql(
+                "events", conn, if_exists="append", index=False
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?)",
+                (path.name, path.stat().st_size, path.stat().st_mtime),
+            )
+        retval.append(path)
+
+    conn.close()
+
+    return retval
 
-        # Add a new column for timestamp
-        df["Datetime"] = pd.to_datetime(
-            df["eventdate"] + " " + df["eventtime"], format="%Y-%m-%d %H:%M:%S"
-        )
-        df["battery_lvl"] = df["eventdesc"].str.split(" ").str[-1].str[:-1].astype(int)
 
-        df["p_id"] = p_id
+def smartwatch_events(
+    p_ids: list[int] = None,
+    start: pd.Timestamp = None,
+    end: pd.Timestamp = None,
+    *,
+    sources: list[str] = None,
+    battery_only: bool = False,
+) -> pd.DataFrame:
+    """
+    Read smartwatch events from the event store, sorted by participant and time
+
+    Run `update_event_store` first to pick up any new databases.
+
+    :param p_ids: participants to read; all participants if not specified
+    :param start: only read events at or after this time
+    :param end: only read events at or before this time
+    :param sources: only read events from the databases with these file names
+    :param battery_only: only read battery level events
+
+    :returns: dataframe of p_id, Datetime, event_type, eventdesc, battery_lvl
+
+    """
+    conditions, params = [], []
+    if p_ids is not None:
+        p_ids = [int(p_id) for p_id in p_ids]
+        conditions.append(f"p_id IN ({', '.join('?' * len(p_ids))})")
+        params.extend(p_ids)
+    if start is not None:
+        conditions.append("Datetime >= ?")
+        params.append(int(pd.Timestamp(start).timestamp()))
+    if end is not None:
+        conditions.append("Datetime <= ?")
+        params.append(int(pd.Timestamp(end).timestamp()))
+    if sources is not None:
+        sources = list(sources)
+        conditions.append(f"source IN ({', '.join('?' * len(sources))})")
+        params.extend(sources)
+    if battery_only:
+        conditions.append("battery_lvl IS NOT NULL")
+
+    query = "SELECT p_id, Datetime, event_type, eventdesc, battery_lvl FROM events"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY p_id, Datetime, rowid"
 
-        dfs.append(df[["p_id", "Datetime", "battery_lvl"]])
+    conn = sqlite3.connect(_event_store_path())
+    retval = pd.read_sql_query(query, conn, params=params)
+    conn.close()
 
-        conn.close()
+    retval["Datetime"] = pd.to_datetime(retval["Datetime"], unit="s")
 
-    battery_df = pd.concat(dfs)
+    return retval
+
+
+def charge_periods(battery_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Find every charging and discharging period for every participant
+
+    A period is a run of consecutive battery readings that all went up (or all went down);
+    a reading where the battery level didn't change ends the period.
+
+    :param battery_df: dataframe of battery levels indexed by datetime, with p_id, battery_lvl
+                       and delta columns. Must be sorted by time within each participant
+    :returns: dataframe with one row per period; columns p_id, direction (1 for charging,
+              -1 for discharging), start, end, duration and rate (battery % per hour)
+
+    """
+    # Put each participant's readings next to each other, keeping the time order
+    order = np.argsort(battery_df["p_id"].values, kind="stable")
+    p_ids = battery_df["p_id"].values[order]
+    levels = battery_df["battery_lvl"].values[order].astype(float)
+    times = battery_df.index.values[order]
+    deltas = battery_df["delta"].values[order]
+
+    new_participant = np.ones(len(p_ids), dtype=bool)
+    new_participant[1:] = p_ids[1:] != p_ids[:-1]
+
+    assert (
+        (np.diff(deltas) >= np.timedelta64(0)) | new_participant[1:]
+    ).all(), "Battery readings not sorted"
+
+    # Sign of the change since the previous reading; 0 for each participant's first
+    sign = np.zeros(len(levels))
+    sign[1:] = np.nan_to_num(np.sign(np.diff(levels)))
+    sign[new_participant] = 0
+
+    # A reading continues a period if it changes in the same direction as the previous one
+    continues = np.zeros(len(sign), dtype=bool)
+    continues[1:] = (sign[1:] == sign[:-1]) & ~new_participant[1:]
+
+    in_period = sign != 0
+    (first,) = np.nonzero(in_period & ~continues)
+    (last,) = np.nonzero(in_period & ~np.append(continues[1:], False))
+
+    # Each period starts at the reading before the first change
+    start, end = times[first - 1], times[last]
+    duration = end - start
+
+    return pd.DataFrame(
+        {
+            "p_id": p_ids[first],
+            "direction": sign[first].astype(np.int8),
+            "start": start,
+            "end": end,
+            "duration": duration,
+            "rate": (levels[last] - levels[first - 1])
+            / (duration / np.timedelta64(1, "h")),
+        }
+    )
+
+
+def _charge_and_discharges(battery_df: pd.DataFrame) -> tuple[dict, dict]:
+    """
+    Number of charge/discharge periods per participant
+
+    """
+    periods = charge_periods(battery_df)
+    counts = pd.crosstab(periods["p_id"], periods["direction"]).reindex(
+        index=np.unique(battery_df["p_id"]), columns=[1, -1], fill_value=0
+    )
+
+    return counts[1].to_dict(), counts[-1].to_dict()
+
+
+def battery_lvl_df() -> pd.DataFrame:
+    """
+    Dataframe of battery level stuff
+
+    Removes battery level with deltas below 0 and 7
+
+    :returns: dataframe with one row per battery reading, with a Datetime column
+
+    """
+    update_event_store()
+
+    # Only the databases that are on the RDSF
+    battery_df = smartwatch_events(
+        sources=[path.name for path in _smartwatch_db_files()], battery_only=True
+    )[["p_id", "Datetime", "battery_lvl"]]
 
     # Add timedelta
-    battery_df["p_id"] = battery_df["p_id"].astype(int)
+    battery_df["battery_lvl"] = battery_df["battery_lvl"].astype(int)
     battery_df = battery_df.set_index("Datetime")
     battery_df = add_timedelta(battery_df)
 
     # Remove battery level with deltas below 0 and 7
     battery_df = battery_df[battery_df["delta"].dt.days >= 1]
-    battery_df = battery_df[battery_df["delta"].dt.days <= 7]
+    battery_df = battery_df[battery_df["delta"].dt.days <= 7].copy()
 
     # Add the number of charge/discharge periods
     charges, discharges = _charge_and_discharges(battery_df)
     battery_df["charges"] = battery_df["p_id"].map(charges)
     battery_df["discharges"] = battery_df["p_id"].map(discharges)
 
-    # Add demographic info
+    # Add demographic info, for the participants who consented
+    # residents_id is NaN for participants not in the questionnaire
     demographic_df = full_questionnaire()
-    demographic_df = demographic_df[demographic_df["respondent_status"] == 1]
-    battery_df = battery_df.merge(
-        demographic_df[
-            ["respondent_sex", "respondent_ethnicity", "age_dob", "residents_id"]
-        ],
-        left_on="p_id",
-        right_on="residents_id",
-        how="left",
-    )
+    demographic_df = demographic_df[
+        (demographic_df["respondent_status"] == 1)
+        & demographic_df["residents_id"].notna()
+    ]
+    demographic_df = demographic_df.set_index(
+        demographic_df["residents_id"].astype(int)
+    )[["respondent_sex", "respondent_ethnicity", "age_dob", "residents_id"]]
+    for column, values in util.broadcast(demographic_df, battery_df["p_id"]).items():
+        battery_df[column] = values.values
 
     # Add Ramadan + early stopping info
-    cleaned_sw = clean.cleaned_smartwatch(keep_catchups=False)
-    battery_df = battery_df.merge(
-        cleaned_sw[["p_id", "all_in_ramadan", "any_in_ramadan", "early_stop"]],
-        on="p_id",
-    )
+    # Only keep participants with cleaned smartwatch entries
+    flag_columns = ["all_in_ramadan", "any_in_ramadan", "early_stop"]
+    flags = clean.participant_flags(keep_catchups=False)[flag_columns]
+    battery_df = battery_df[battery_df["p_id"].isin(flags.index)].copy()
+    battery_df[flag_columns] = util.broadcast(flags, battery_df["p_id"]).values
 
-    return battery_df
+    return battery_df.reset_index()
@@ -2,10 +2,13 @@
 General utility functions
 
 """
-import warnings
+import logging
+from functools import cache
+
 import numpy as np
 import pandas as pd
-import traceback
+
+from . import diagnostics
 
 # How often the accelerometer took a measurement
 SAMPLE_RATE_HZ = 100
@@ -13,6 +16,8 @@ SAMPLE_RATE_HZ = 100
 # Gravity
 GRAVITY_MS2 = 9.81
 
+_NS_PER_DAY = 24 * 60 * 60 * 1_000_000_000
+
 
 class bcolour:
     HEADER = "\033[95m"
@@ -38,6 +43,77 @@ def count_dict(array: np.ndarray) -> dict:
     return dict(zip(*np.unique(array, return_counts=True)))
 
 
+def combine_date_time(
+    dates: pd.Series,
+    times: pd.Series,
+    *,
+    date_format: str,
+    time_format: str = r"%H:%M:%S",
+) -> pd.Series:
+    """
+    Parse separate date and time-of-day columns into a single series of datetimes
+
+    Each distinct date and each distinct time string is only parsed once; the
+    parsed values are then combined with integer arithmetic. There are far fewer
+    distinct dates/times than rows, so this is much faster than concatenating
+    the strings and parsing every row.
+
+    :param dates: series of dates; converted to str before parsing
+    :param times: series of time-of-day strings
+    :param date_format: strptime format of the dates, e.g. "%d%b%Y"
+    :param time_format: strptime format of the times
+
+    :returns: series of datetimes with the same index as `dates`.
+              NaT where either the date or time is missing
+
+    """
+    date_codes, unique_dates = pd.factorize(dates)
+    time_codes, unique_times = pd.factorize(times)
+
+    date_ns = (
+        pd.to_datetime(unique_dates.map(str), format=date_format)
+        .values.astype("datetime64[ns]")
+        .view(np.int64)
+    )
+
+    # Parse the times against a dummy date, then remove the date part
+    parsed_times = pd.to_datetime(unique_times, format=time_format)
+    time_ns = (
+        (parsed_times - parsed_times.normalize())
+        .values.astype("timedelta64[ns]")
+        .view(np.int64)
+    )
+
+    combined = date_ns.take(date_codes) + time_ns.take(time_codes)
+
+    retval = pd.Series(combined.view("datetime64[ns]"), index=dates.index)
+    retval[(date_codes == -1) | (time_codes == -1)] = pd.NaT
+
+    return retval
+
+
+def broadcast(table: pd.DataFrame, keys: pd.Series) -> pd.DataFrame:
+    """
+    Gather rows from a table onto a series of keys, like `keys.map` for every column at once
+
+    Use this instead of merging to join e.g. per-participant information onto
+    a dataframe of entries - it doesn't reset or copy the entry dataframe
+
+    :param table: dataframe indexed by a unique key, e.g. participant ID
+    :param keys: series of keys to look up in the table (may contain repeats)
+
+    :returns: dataframe of the table's columns with the same index as `keys`.
+              Keys not in the table give NaN rows
+
+    """
+    assert table.index.is_unique, "Table index must be unique"
+
+    retval = table.reindex(keys.values)
+    retval.index = keys.index
+
+    return retval
+
+
 def lockdown_end() -> pd.Timestamp:
     return pd.to_datetime("2022-04-17")
 
@@ -49,29 +125,240 @@ def ramadan_2022() -> pd.Series:
     return pd.to_datetime(["2022-04-02", "2022-05-02"])
 
 
-def in_ramadan_2022(dates: pd.Series, verbose: bool = True) -> pd.Series:
+class Calendar:
+    """
+    Named periods of time, e.g. Ramadan or lockdown, which may overlap
+
+    All the interval boundaries are kept in one sorted array, along with which
+    intervals each gap between boundaries is in; datetimes are then classified
+    against every interval at once with a single `searchsorted`
+
+    """
+
+    def __init__(self, intervals: dict[str, tuple[pd.Timestamp, pd.Timestamp]] = None):
+        """
+        :param intervals: dict of {name: (start, end)}. Both ends are inclusive;
+                          None for an interval with no start/end
+
+        """
+        self.intervals = {}
+        for name, (start, end) in (intervals or {}).items():
+            self.add(name, start, end)
+
+    def add(self, name: str, start: pd.Timestamp, end: pd.Timestamp) -> None:
+        """
+        Add (or replace) an interval
+
+        :param name: name of the interval, e.g. "school_holiday"
+        :param start: first time in the interval; None for no start
+        :param end: last time in the interval (inclusive); None for no end
+
+        """
+        start = None if start is None else pd.Timestamp(start)
+        end = None if end is None else pd.Timestamp(end)
+        if start is not None and end is not None:
+            assert start <= end, f"{name}: {start=} is after {end=}"
+
+        self.intervals[name] = (start, end)
+
+        # Keep the intervals as [start, end + 1ns) in int64 nanoseconds, so that
+        # every interval includes its left boundary and excludes its right
+        int64 = np.iinfo(np.int64)
+        starts = np.array(
+            [
+                int64.min + 1 if s is None else s.value
+                for s, _ in self.intervals.values()
+            ]
+        )
+        ends = np.array(
+            [
+                int64.max if e is None else e.value + 1
+                for _, e in self.intervals.values()
+            ]
+        )
+
+        # Row i of the membership table says which intervals the times between
+        # boundaries i - 1 and i are in; before the first boundary is in none
+        self._boundaries = np.unique(np.concatenate([starts, ends]))
+        left = self._boundaries[:, np.newaxis]
+        self._membership = np.concatenate(
+            [
+                np.zeros((1, len(starts)), dtype=bool),
+                (starts <= left) & (left < ends),
+            ]
+        )
+
+    def _segments(self, dates) -> np.ndarray:
+        """
+        Row of the membership table for each datetime; NaT is in no interval
+
+        """
+        times = np.asarray(dates, dtype="datetime64[ns]").view(np.int64)
+        segments = np.searchsorted(self._boundaries, times, side="right")
+        segments[times == np.iinfo(np.int64).min] = 0
+
+        return segments
+
+    def flags(self, dates) -> pd.DataFrame:
+        """
+        Whether each datetime is in each interval
+
+        :param dates: series, index or array of datetimes
+
+        :returns: boolean dataframe with a column per interval, with the same
+                  index as `dates` if it is a series/index
+
+        """
+        if isinstance(dates, pd.Series):
+            index = dates.index
+        elif isinstance(dates, pd.Index):
+            index = dates
+        else:
+            index = None
+
+        return pd.DataFrame(
+            self._membership[self._segments(dates)],
+            columns=list(self.intervals),
+            index=index,
+        )
+
+    def contains(self, name: str, dates) -> np.ndarray:
+        """
+        Whether each datetime is in one interval
+
+        :param name: name of the interval
+        :param dates: series, index or array of datetimes
+
+        :returns: boolean array
+
+        """
+        column = list(self.intervals).index(name)
+        return self._membership[self._segments(dates), column]
+
+
+@cache
+def study_calendar() -> Calendar:
+    """
+    The periods during the study that might affect participants' entries
+
+    Shared between calls, so intervals added to it (e.g. school holidays) are
+    seen everywhere
+
+    """
+    return Calendar(
+        {
+            "ramadan": tuple(ramadan_2022()),
+            "lockdown": (None, lockdown_end()),
+        }
+    )
+
+
+def date_codes(times) -> tuple[np.ndarray, pd.DatetimeIndex]:
+    """
+    Which distinct date each datetime falls on
+
+    :param times: series, index or array of datetimes
+
+    :returns: an integer code for each datetime (-1 for NaT), and the sorted
+              distinct dates that the codes index into
+
+    """
+    ns = np.asarray(times, dtype="datetime64[ns]").view(np.int64)
+    valid = ns != np.iinfo(np.int64).min
+
+    days, inverse = np.unique(ns[valid] // _NS_PER_DAY, return_inverse=True)
+
+    codes = np.full(len(ns), -1, dtype=np.int64)
+    codes[valid] = inverse
+
+    return codes, pd.DatetimeIndex((days * _NS_PER_DAY).view("datetime64[ns]"))
+
+
+def date_table(dates: pd.DatetimeIndex, calendar: Calendar = None) -> pd.DataFrame:
+    """
+    Calendar features of each date
+
+    The calendar intervals are checked at midnight at the start of each date, so
+    e.g. the last day of Ramadan counts as in Ramadan even though the interval
+    ends at midnight; use `Calendar.flags` directly for times within a day
+
+    :param dates: distinct dates, e.g. from `date_codes`
+    :param calendar: intervals to flag; defaults to `study_calendar()`
+
+    :returns: dataframe indexed by date, with the weekday name, whether it's a
+              weekend and a boolean column for each calendar interval
+
+    """
+    calendar = study_calendar() if calendar is None else calendar
+
+    table = pd.DataFrame(
+        {"weekday": dates.day_name(), "weekend": dates.dayofweek >= 5}, index=dates
+    )
+    return pd.concat([table, calendar.flags(dates)], axis=1)
+
+
+def date_features(times, calendar: Calendar = None) -> pd.DataFrame:
+    """
+    Calendar features of the date of each datetime
+
+    The features are found once per distinct date with `date_table`, then
+    gathered onto the datetimes by their date codes
+
+    :param times: series, index or array of datetimes
+    :param calendar: intervals to flag; defaults to `study_calendar()`
+
+    :returns: dataframe with the same index as `times` if it is a series/index.
+              NaT gives a row of NaN
+
+    """
+    codes, dates = date_codes(times)
+    table = date_table(dates, calendar).reset_index(drop=True)
+
+    if isinstance(times, pd.Series):
+        index = times.index
+    elif isinstance(times, pd.Index):
+        index = times
+    else:
+        index = None
+
+    return broadcast(table, pd.Series(codes, index=index))
+
+
+def in_ramadan_2022(dates: pd.Series, verbose: bool = False) -> pd.Series:
     """
     Boolean mask indicating whether a series of datetimes are n ramadan
 
     :param dates: series of datetimes
-    :param verbose: warnings
-    :raises: warning if the dates are not all in 2022
+    :param verbose: also check the dates, recording a warning (see `diagnostics`)
+                    if they are not all in 2022. Off by default, since the check
+                    costs more than the classification
+
+    :returns: boolean series with the same index, if `dates` is a series;
+              otherwise a boolean array
 
     """
     # Check if the dates are all in 2022
-    try:
-        if set(dates.year.unique()) != {2022}:
-            if verbose:
-                warnings.warn(
-                    f"Not all dates are in 2022: {set(dates.year.unique())=} "
+    if verbose and diagnostics.enabled(logging.WARNING):
+        try:
+            years = set(dates.year.unique())
+            if years != {2022}:
+                diagnostics.record(
+                    "in_ramadan_2022",
+                    f"Not all dates are in 2022: {years=}",
+                    level=logging.WARNING,
+                    stack_info=True,
                 )
-                traceback.print_stack(limit=5)
 
-    except AttributeError:
-        if verbose:
-            warnings.warn(f"Dates are not a datetime series: {type(dates)=}")
-            traceback.print_stack(limit=5)
+        except AttributeError:
+            diagnostics.record(
+                "in_ramadan_2022",
+                f"Dates are not a datetime series: {type(dates)=}",
+                level=logging.WARNING,
+                stack_info=True,
+            )
 
     # Check whether they're in 2022 ramadan
-    start, end = ramadan_2022()
-    return (start <= dates) & (dates <= end)
+    in_ramadan = study_calendar().contains("ramadan", dates)
+    if isinstance(dates, pd.Series):
+        return pd.Series(in_ramadan, index=dates.index)
+    return in_ramadan
@@ -0,0 +1,182 @@
+"""
+Build a dataset of accelerometer windows before each smartwatch entry
+
+The windows are stored in one memory-mapped float32 array of shape
+(n_windows, n_samples, n_channels), alongside a table describing each window,
+so that clustering/model training can stream over them without re-reading
+and re-filtering the accelerometer files.
+
+"""
+import json
+import pathlib
+from typing import Callable, Iterable
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from . import read, clean, util
+
+CHANNELS = ("accel_x", "accel_y", "accel_z", "gyro_x", "gyro_y", "gyro_z")
+
+# Entries that a participant actually made, i.e. not catch-up markers or No response
+MEAL_TYPES = ("Meal", "Drink", "Snack", "No food/drink")
+
+# Files making up a dataset
+_ARRAY = "windows.f32"
+_METADATA = "metadata.parquet"
+_INFO = "info.json"
+
+
+def _window_samples(
+    samples: pd.DataFrame,
+    start: pd.Timestamp,
+    n_samples: int,
+    channels: tuple[str],
+) -> np.ndarray:
+    """
+    Interpolate samples onto a regular grid of times at the sample rate
+
+    :param samples: accelerometer data indexed by time
+    :param start: time of the first point on the grid
+    :param n_samples: number of points on the grid
+    :param channels: columns to take
+
+    :returns: array of shape (n_samples, n_channels), or None if the samples
+              don't cover the whole grid
+
+    """
+    period_ns = 1_000_000_000 // util.SAMPLE_RATE_HZ
+    grid = start.value + np.arange(n_samples, dtype=np.int64) * period_ns
+    times = samples.index.values.astype("datetime64[ns]").view(np.int64)
+
+    # Allow the recording to start/end up to one sample period inside the window
+    if not len(times) or times[0] > grid[0] + period_ns:
+        return None
+    if times[-1] < grid[-1] - period_ns:
+        return None
+
+    return np.stack(
+        [np.interp(grid, times, samples[channel].values) for channel in channels],
+        axis=1,
+    )
+
+
+def build_meal_windows(
+    out_dir: pathlib.Path,
+    *,
+    window_length: pd.Timedelta = pd.Timedelta(1, "hour"),
+    channels: tuple[str] = CHANNELS,
+    meal_types: Iterable[str] = MEAL_TYPES,
+    p_ids: Iterable[int] = None,
+    transform: Callable[[pd.Series], pd.Series] = None,
+    keep_catchups: bool = False,
+) -> tuple[np.memmap, pd.DataFrame]:
+    """
+    Write the accelerometer data before every smartwatch entry to a dataset
+
+    Windows are read from the converted accelerometer data (see convert_cwa.py)
+    if it exists, otherwise just the right part of each CWA file is read.
+    Windows that aren't completely covered by the recording are left out.
+
+    :param out_dir: directory to write the dataset to
+    :param window_length: how long before each entry to take
+    :param channels: which accelerometer/gyroscope channels to keep
+    :param meal_types: only keep entries of these meal types, e.g. {"Meal", "Snack"}.
+                       Defaults to the entries the participant made; pass None to
+                       keep every entry, including catch-up markers and No response
+    :param p_ids: only keep entries from these participants
+    :param transform: applied to each channel of each window, e.g.
+                      `lambda x: smooth.bandpass_filter(x - x.mean(), order=3)`
+    :param keep_catchups: whether to keep catch-up entries
+
+    :returns: the windows and their metadata, as returned by `load_meal_windows`
+
+    """
+    n_samples = int(window_length.total_seconds() * util.SAMPLE_RATE_HZ)
+    channels = tuple(channels)
+
+    entries = clean.cleaned_smartwatch(keep_catchups=keep_catchups)
+    if meal_types is not None:
+        entries = entries[entries["meal_type"].isin(set(meal_types))]
+    if p_ids is not None:
+        entries = entries[entries["p_id"].isin(set(p_ids))]
+
+    recordings = read.cwa_files()
+    recordings = recordings[recordings["p_id"].isin(entries["p_id"].unique())]
+
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    metadata = []
+    with open(out_dir / _ARRAY, "wb") as array_file:
+        for recording in tqdm(recordings.itertuples(), total=len(recordings)):
+            participant_entries = entries[entries["p_id"] == recording.p_id]
+            converted = read.is_converted(recording.path)
+
+            for time, meal_type in zip(
+                participant_entries.index, participant_entries["meal_type"]
+            ):
+                start = time - window_length
+                if converted:
+                    samples = read.converted_accel_info(recording.path, start, time)
+                else:
+                    samples = read.accel_info(str(recording.path), start, time)
+
+                window = _window_samples(samples, start, n_samples, channels)
+                if window is None:
+                    continue
+
+                if transform is not None:
+                    for i, channel in enumerate(channels):
+                        window[:, i] = transform(pd.Series(window[:, i]))
+
+                array_file.write(window.astype(np.float32).tobytes())
+                metadata.append((recording.p_id, meal_type, time, start))
+
+    metadata = pd.DataFrame(
+        metadata, columns=["p_id", "meal_type", "Datetime", "start"]
+    ).astype({"p_id": int, "Datetime": "datetime64[ns]", "start": "datetime64[ns]"})
+    metadata.index.name = "window"
+    metadata.to_parquet(out_dir / _METADATA)
+
+    with open(out_dir / _INFO, "w") as f:
+        json.dump(
+            {
+                "n_samples": n_samples,
+                "channels": list(channels),
+                "sample_rate_hz": util.SAMPLE_RATE_HZ,
+            },
+            f,
+            indent=1,
+        )
+
+    return load_meal_windows(out_dir)
+
+
+def load_meal_windows(out_dir: pathlib.Path) -> tuple[np.memmap, pd.DataFrame]:
+    """
+    Open a dataset written by `build_meal_windows`
+
+    The windows aren't read into memory; slicing the array reads just those windows.
+
+    :param out_dir: directory the dataset was written to
+
+    :returns: read-only array of shape (n_windows, n_samples, n_channels) and a
+              dataframe with one row per window holding its p_id, meal_type,
+              entry time (Datetime) and window start time
+
+    """
+    out_dir = pathlib.Path(out_dir)
+
+    metadata = pd.read_parquet(out_dir / _METADATA)
+    with open(out_dir / _INFO, "r") as f:
+        info = json.load(f)
+
+    shape = (len(metadata), info["n_samples"], len(info["channels"]))
+    if not len(metadata):
+        return np.empty(shape, dtype=np.float32), metadata
+
+    windows = np.memmap(out_dir / _ARRAY, dtype=np.float32, mode="r", shape=shape)
+
+    return windows, metadata
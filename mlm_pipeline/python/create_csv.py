@@ -2,23 +2,108 @@
 Create a CSV file holding the relevant, cleaned data from file;
 ready to run a multi-level model
 
+Optionally also write the same table as a feather file, which is much quicker
+for R to read and keeps the column types, and/or a collapsed table of the
+number of positive entries and prompts for each participant on each day
+
 """
 
 import sys
 import pathlib
+import argparse
 import numpy as np
 import pandas as pd
 
 sys.path.append(str(pathlib.Path(__file__).parent.parents[1].absolute()))
 
-from ema import read, clean
+from ema import read, clean, util
+
+# Types of the columns in the feather file, so that R doesn't have to guess them
+# Integers are nullable, since not every participant answered every question.
+# Strings become categories; read_model_df.R makes these factors with their levels
+# in a fixed order, so the reference levels don't depend on which file R reads
+EXPORT_TYPES = {
+    "p_id": "Int64",
+    "day": "Int16",
+    "meal_type": "category",
+    "weekday": "category",
+    "is_weekend": "Int8",
+    "all_in_ramadan": "Int8",
+    "sex": "Int8",
+    "ethnicity": "Int8",
+    "age_dob": "Int8",
+    "phyactq1": "Int8",
+    "smart1_10to17": "Int8",
+    "smart1_7to9": "Int8",
+    "age_group": "Int8",
+    "weekend": "Int8",
+    "first_weekday": "category",
+    "over_2_days_in_school": "Int8",
+    "entry": "Int8",
+    "successes": "Int16",
+    "failures": "Int16",
+    "trials": "Int16",
+}
+
+# Columns that can differ between entries on the same day; every other column
+# is the same for a participant on a given day, so is kept in the binomial table
+PER_ENTRY_COLUMNS = ["meal_type", "Datetime", "entry"]
+
+
+def write_table(table: pd.DataFrame, path: pathlib.Path, *, feather: bool) -> None:
+    """
+    Write a table to CSV, and optionally to feather with the types in EXPORT_TYPES
+
+    If we're not writing the feather file, any old one is deleted so that R
+    doesn't read out of date data from it
+
+    :param table: dataframe to write
+    :param path: where to write the CSV; the feather file is written alongside it
+    :param feather: whether to write the feather file
+
+    """
+    table.to_csv(path, index=False)
+
+    feather_path = path.with_suffix(".feather")
+    if not feather:
+        feather_path.unlink(missing_ok=True)
+        return
+
+    types = {column: EXPORT_TYPES[column] for column in table if column in EXPORT_TYPES}
+    table.astype(types).reset_index(drop=True).to_feather(feather_path)
+
+
+def binomial_table(model_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Collapse the model dataframe to one row per participant, day and combination
+    of covariates, counting the positive entries and prompts
+
+    A model fit to `cbind(successes, failures)` from this table gives the same
+    estimates as one fit to `entry` from the model dataframe, on far fewer rows
 
+    :param model_df: one row per smartwatch prompt
+    :returns: dataframe of the covariates, successes (positive entries),
+              failures (prompts without a response) and trials (prompts)
 
-def main():
+    """
+    covariates = [column for column in model_df if column not in PER_ENTRY_COLUMNS]
+
+    # Keep the rows with missing covariates, in case a model doesn't use them
+    grouped = model_df.groupby(covariates, dropna=False, sort=True)["entry"]
+    table = pd.DataFrame({"successes": grouped.sum(), "trials": grouped.size()})
+    table["failures"] = table["trials"] - table["successes"]
+
+    return table[["successes", "failures", "trials"]].reset_index()
+
+
+def main(*, feather: bool, binomial: bool):
     """
     Read, clean data + send to csv
 
     """
+    # Start copying the files we'll need from RDSF while the meal info is read
+    read.prefetch("questionnaire", "feasibility_info")
+
     meal_info = clean.cleaned_smartwatch(keep_catchups=False)
 
     model_df = pd.DataFrame()
@@ -26,6 +111,7 @@ def main():
     # Participant ID and entry day
     model_df["p_id"] = meal_info["p_id"]
     model_df["day"] = meal_info["delta"].dt.days
+    model_df["meal_type"] = meal_info["meal_type"]
 
     # Weekday information
     model_df["weekday"] = meal_info["week_day"]
@@ -37,24 +123,18 @@ def main():
     model_df["all_in_ramadan"] = meal_info["all_in_ramadan"].astype(int)
 
     # Demographic information
-    demographic_df = read._qnaire_df()
-    demographic_df = demographic_df[demographic_df["respondent_status"] == 1]
-    demographic_df = demographic_df[
-        [
-            "residents_id",
-            "respondent_sex",
-            "respondent_ethnicity",
-            "age_dob",
-            "phyactq1",
-            "smart1_10to17",
-            "smart1_7to9",
-        ]
+    demographic_columns = [
+        "respondent_sex",
+        "respondent_ethnicity",
+        "age_dob",
+        "phyactq1",
+        "smart1_10to17",
+        "smart1_7to9",
     ]
-    model_df = (
-        model_df.reset_index()
-        .merge(demographic_df, left_on="p_id", right_on="residents_id", how="left")
-        .set_index(model_df.index)
-    )
+    model_df[demographic_columns] = read.participant_facts(
+        model_df["p_id"], demographic_columns, consented_only=True
+    ).values
+    model_df["Datetime"] = model_df.index
 
     # Keep only participants who wore the smartwatch
     keep = (model_df["smart1_10to17"] == 1) | (model_df["smart1_7to9"] == 1)
@@ -71,14 +151,14 @@ def main():
     model_df["age_group"] = (model_df["age_dob"] > 12).astype(int)
 
     # Whether each day was a weekend or weekday
-    model_df["weekend"] = model_df["Datetime"].dt.dayofweek.isin({5, 6}).astype(int)
+    # Found once per date, since there are far fewer dates than entries
+    dates = util.date_features(model_df["Datetime"])
+    model_df["weekend"] = dates["weekend"].astype(int)
 
     # What day of the week each participant started on
-    model_df["first_weekday"] = pd.NA
-    for p_id in model_df["p_id"].unique():
-        model_df.loc[model_df["p_id"] == p_id, "first_weekday"] = model_df.loc[
-            model_df["p_id"] == p_id, "weekday"
-        ].iloc[0]
+    model_df["first_weekday"] = model_df.groupby("p_id", sort=False)[
+        "weekday"
+    ].transform("first")
 
     # How many days each participant spent in school
     model_df["over_2_days_in_school"] = (model_df["phyactq1"] > 2).astype(int)
@@ -105,10 +185,30 @@ def main():
         inplace=True,
     )
 
-    model_df.to_csv(
-        pathlib.Path(__file__).parents[1] / "data" / "model_df.csv", index=False
-    )
+    data_dir = pathlib.Path(__file__).parents[1] / "data"
+    write_table(model_df, data_dir / "model_df.csv", feather=feather)
+
+    if binomial:
+        write_table(
+            binomial_table(model_df), data_dir / "binomial_df.csv", feather=feather
+        )
+    else:
+        # Delete any old binomial table so R doesn't read out of date data from it
+        for suffix in (".csv", ".feather"):
+            (data_dir / "binomial_df").with_suffix(suffix).unlink(missing_ok=True)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--feather",
+        action="store_true",
+        help="also write the table to a feather file, for the R scripts to read",
+    )
+    parser.add_argument(
+        "--binomial",
+        action="store_true",
+        help="also write a table of successes/trials per participant per day",
+    )
+
+    main(**vars(parser.parse_args()))
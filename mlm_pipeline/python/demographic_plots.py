@@ -3,11 +3,36 @@ Create demographic plots for all the variables we're looking at
 
 """
 import os
+import json
+import inspect
+import hashlib
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
+import matplotlib
+
+# Only writing files, so use a non-interactive backend (this also makes it safe to
+# plot from worker processes)
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 
+OUTPUT_DIR = "mlm_pipeline/outputs/demographics/"
+
+# Hashes of the data + code used to make each figure
+HASH_FILE = os.path.join(OUTPUT_DIR, "input_hashes.json")
+
+DAY_LOOKUP = {
+    1: "Monday",
+    2: "Tuesday",
+    3: "Wednesday",
+    4: "Thursday",
+    5: "Friday",
+    6: "Saturday",
+    7: "Sunday",
+}
+
 
 def age_hist(demographic_df):
     fig, ax = plt.subplots()
@@ -23,7 +48,7 @@ def age_hist(demographic_df):
     ax.set_xlabel("Age")
 
     fig.tight_layout()
-    fig.savefig("mlm_pipeline/outputs/demographics/age_hist.png")
+    return fig
 
 
 def age_stacked_bar(demographic_df):
@@ -51,16 +76,7 @@ def age_stacked_bar(demographic_df):
     ax.set_xlabel("Age group")
 
     fig.tight_layout()
-    fig.savefig("mlm_pipeline/outputs/demographics/age_stacked.png")
-
-
-def age_hists(demographic_df):
-    """
-    Histogram of ages, and stacked histogram showing age groups
-
-    """
-    age_hist(demographic_df)
-    age_stacked_bar(demographic_df)
+    return fig
 
 
 def ethnicity_plot(demographic_df):
@@ -78,7 +94,7 @@ def ethnicity_plot(demographic_df):
         autopct=autopct,
     )
     fig.tight_layout()
-    fig.savefig("mlm_pipeline/outputs/demographics/ethnicity.png")
+    return fig
 
 
 def sex_plot(demographic_df):
@@ -97,7 +113,7 @@ def sex_plot(demographic_df):
         autopct=autopct,
     )
     fig.tight_layout()
-    fig.savefig("mlm_pipeline/outputs/demographics/sexes.png")
+    return fig
 
 
 def school_hist(demographic_df):
@@ -112,7 +128,7 @@ def school_hist(demographic_df):
     ax.set_xlabel("Number of days in school")
 
     fig.tight_layout()
-    fig.savefig("mlm_pipeline/outputs/demographics/school_hist.png")
+    return fig
 
 
 def school_stacked_bar(demographic_df):
@@ -141,12 +157,7 @@ def school_stacked_bar(demographic_df):
     ax.set_ylabel("Count")
 
     fig.tight_layout()
-    fig.savefig("mlm_pipeline/outputs/demographics/school_stacked.png")
-
-
-def school_plot(demographic_df):
-    school_hist(demographic_df)
-    school_stacked_bar(demographic_df)
+    return fig
 
 
 def weekday_hist(demographic_df, day_lookup):
@@ -163,7 +174,7 @@ def weekday_hist(demographic_df, day_lookup):
     ax.set_xticks(range(1, 8), [day_lookup[i] for i in range(1, 8)])
 
     fig.tight_layout()
-    fig.savefig("mlm_pipeline/outputs/demographics/weekday_hist.png")
+    return fig
 
 
 def weekday_stacked_bar(demographic_df, day_lookup):
@@ -192,14 +203,11 @@ def weekday_stacked_bar(demographic_df, day_lookup):
     ax.set_xlabel("Day")
 
     fig.tight_layout()
-    fig.savefig("mlm_pipeline/outputs/demographics/weekday_stacked.png")
+    return fig
 
 
 def first_weekday(demographic_df, day_lookup):
-    days = []
-    for pid in demographic_df["p_id"].unique():
-        first_day = demographic_df[demographic_df["p_id"] == pid]["weekday"].iloc[0]
-        days.append(first_day)
+    days = demographic_df.groupby("p_id", sort=False)["weekday"].first()
 
     fig, ax = plt.subplots()
     bins = np.arange(1, 8)
@@ -215,41 +223,100 @@ def first_weekday(demographic_df, day_lookup):
     ax.set_title("First day of data collection")
 
     fig.tight_layout()
-    fig.savefig("mlm_pipeline/outputs/demographics/first_day.png")
-
-
-def weekdays_plot(demographic_df):
-    day_lookup = {
-        1: "Monday",
-        2: "Tuesday",
-        3: "Wednesday",
-        4: "Thursday",
-        5: "Friday",
-        6: "Saturday",
-        7: "Sunday",
-    }
-    weekday_hist(demographic_df, day_lookup)
-    weekday_stacked_bar(demographic_df, day_lookup)
-    first_weekday(demographic_df, day_lookup)
+    return fig
+
+
+def _input_hash(plot_fcn, data: pd.DataFrame) -> str:
+    """
+    Hash of the data and code used to make a figure, including any arguments
+    bound to the plotting function with `partial` (e.g. DAY_LOOKUP)
+
+    """
+    hasher = hashlib.sha1(pd.util.hash_pandas_object(data, index=False).values)
+    hasher.update(inspect.getsource(getattr(plot_fcn, "func", plot_fcn)).encode())
+
+    if isinstance(plot_fcn, partial):
+        hasher.update(repr((plot_fcn.args, sorted(plot_fcn.keywords.items()))).encode())
+
+    return hasher.hexdigest()
+
+
+def _render(plot_fcn, data: pd.DataFrame, filename: str) -> None:
+    """
+    Make a figure and save it
+
+    """
+    fig = plot_fcn(data)
+    fig.savefig(os.path.join(OUTPUT_DIR, filename))
+    plt.close(fig)
 
 
 def main():
-    if not os.path.isdir("mlm_pipeline/outputs/demographics/"):
-        os.mkdir("mlm_pipeline/outputs/demographics/")
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
 
     entries_df = pd.read_csv("mlm_pipeline/data/model_df.csv")
 
-    # These plots are for all entries
-    weekdays_plot(entries_df)
-
     # Throw away all but one entry per participant
-    # This means that subsequent plots are for participants, not entries
-    entries_df = entries_df.drop_duplicates(subset="p_id")
+    # This means that these plots are for participants, not entries
+    participant_df = entries_df.drop_duplicates(subset="p_id")
+
+    # Each figure, the function that makes it and the data it uses
+    figures = {
+        # These plots are for all entries
+        "weekday_hist.png": (
+            partial(weekday_hist, day_lookup=DAY_LOOKUP),
+            entries_df[["weekday"]],
+        ),
+        "weekday_stacked.png": (
+            partial(weekday_stacked_bar, day_lookup=DAY_LOOKUP),
+            entries_df[["weekday"]],
+        ),
+        "first_day.png": (
+            partial(first_weekday, day_lookup=DAY_LOOKUP),
+            entries_df[["p_id", "weekday"]],
+        ),
+        # These are for participants
+        "age_hist.png": (age_hist, participant_df[["age_dob"]]),
+        "age_stacked.png": (age_stacked_bar, participant_df[["age_dob"]]),
+        "ethnicity.png": (ethnicity_plot, participant_df[["ethnicity"]]),
+        "sexes.png": (sex_plot, participant_df[["sex"]]),
+        "school_hist.png": (school_hist, participant_df[["phyactq1"]]),
+        "school_stacked.png": (school_stacked_bar, participant_df[["phyactq1"]]),
+    }
+
+    # Only make the figures whose data or code has changed since they were last made
+    try:
+        with open(HASH_FILE, "r") as f:
+            old_hashes = json.load(f)
+    except FileNotFoundError:
+        old_hashes = {}
 
-    age_hists(entries_df)
-    ethnicity_plot(entries_df)
-    sex_plot(entries_df)
-    school_plot(entries_df)
+    hashes = {
+        filename: _input_hash(plot_fcn, data)
+        for filename, (plot_fcn, data) in figures.items()
+    }
+    stale = [
+        filename
+        for filename in figures
+        if old_hashes.get(filename) != hashes[filename]
+        or not os.path.exists(os.path.join(OUTPUT_DIR, filename))
+    ]
+    print(f"Making {len(stale)} of {len(figures)} figures")
+
+    with ProcessPoolExecutor() as executor:
+        futures = {
+            filename: executor.submit(_render, *figures[filename], filename)
+            for filename in stale
+        }
+
+    # Only record the hashes of the figures that were made successfully
+    for filename, future in futures.items():
+        if future.exception() is not None:
+            print(f"Failed to make {filename}: {future.exception()!r}")
+            hashes[filename] = old_hashes.get(filename)
+
+    with open(HASH_FILE, "w") as f:
+        json.dump(hashes, f, indent=1)
 
 
 if __name__ == "__main__":
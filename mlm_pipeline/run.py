@@ -0,0 +1,258 @@
+"""
+Run the multi-level model pipeline
+
+Each stage declares the files it reads and writes. A stage is only re-run if one
+of its outputs is missing, or if the contents of its inputs (or its command) have
+changed since it last ran successfully. Stages that don't depend on each other
+are run in parallel.
+
+"""
+import sys
+import time
+import json
+import yaml
+import hashlib
+import pathlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+# Hashes of each stage's inputs the last time it ran successfully
+STATE_FILE = ROOT / "mlm_pipeline" / "data" / "pipeline_state.json"
+
+# Each stage's output is written here, so that stages running in parallel
+# don't print over each other
+LOG_DIR = ROOT / "mlm_pipeline" / "outputs" / "logs"
+
+# Paths are relative to the repo root; inputs can be glob patterns.
+# "data" are the raw data files on RDSF that a stage reads, as their keys in config.yaml
+STAGES = {
+    "create_csv": {
+        "command": [
+            sys.executable,
+            "mlm_pipeline/python/create_csv.py",
+            "--feather",
+            "--binomial",
+        ],
+        "inputs": [
+            "mlm_pipeline/python/create_csv.py",
+            "ema/*.py",
+            "config.yaml",
+        ],
+        "data": ["meal_info", "questionnaire", "feasibility_info"],
+        "outputs": [
+            "mlm_pipeline/data/model_df.csv",
+            "mlm_pipeline/data/model_df.feather",
+            "mlm_pipeline/data/binomial_df.csv",
+            "mlm_pipeline/data/binomial_df.feather",
+        ],
+    },
+    "stats": {
+        "command": [sys.executable, "mlm_pipeline/python/stats.py"],
+        "inputs": ["mlm_pipeline/python/stats.py", "mlm_pipeline/data/model_df.csv"],
+        "outputs": [],
+    },
+    # Compare the different multi level models - to motivate that the random
+    # intercept and slope model is the best
+    "compare_day_models": {
+        "command": ["Rscript", "mlm_pipeline/r/compare_day_models.R"],
+        "inputs": [
+            "mlm_pipeline/r/compare_day_models.R",
+            "mlm_pipeline/r/read_model_df.R",
+            "mlm_pipeline/data/binomial_df.csv",
+        ],
+        "outputs": [
+            "mlm_pipeline/outputs/fixed_only_fit.png",
+            "mlm_pipeline/outputs/random_intercepts_fit.png",
+            "mlm_pipeline/outputs/random_intercept_and_slope_fit.png",
+            "mlm_pipeline/outputs/random_intercepts_all.png",
+            "mlm_pipeline/outputs/random_pids_fit_all.png",
+            "random_pid_effects_hists.png",
+        ],
+    },
+    # Run models with fixed effects from demographic information
+    "demographic_models": {
+        "command": ["Rscript", "mlm_pipeline/r/demographic_models.R"],
+        "inputs": [
+            "mlm_pipeline/r/demographic_models.R",
+            "mlm_pipeline/r/read_model_df.R",
+            "mlm_pipeline/data/binomial_df.csv",
+        ],
+        "outputs": [
+            "mlm_pipeline/outputs/sex_fit.png",
+            "mlm_pipeline/outputs/ethnicity_fit.png",
+            "mlm_pipeline/outputs/age_fit.png",
+            "mlm_pipeline/outputs/school_fit.png",
+            "mlm_pipeline/outputs/weekday_fit.png",
+            "mlm_pipeline/outputs/start_day_fit.png",
+            "mlm_pipeline/outputs/ramadan_fit.png",
+        ],
+    },
+}
+
+
+def _dependencies(stages: dict) -> dict[str, set[str]]:
+    """
+    Which stages each stage depends on; i.e. the stages that write its inputs
+
+    """
+    writers = {
+        output: name for name, stage in stages.items() for output in stage["outputs"]
+    }
+    return {
+        name: {writers[path] for path in stage["inputs"] if path in writers}
+        for name, stage in stages.items()
+    }
+
+
+def _data_path(key: str) -> pathlib.Path:
+    """
+    Path to a raw data file on RDSF, from its key in config.yaml
+
+    """
+    with open(ROOT / "userconf.yaml", "r") as stream:
+        seaco_dir = yaml.safe_load(stream)["seaco_dir"]
+    with open(ROOT / "config.yaml", "r") as stream:
+        return pathlib.Path(seaco_dir) / yaml.safe_load(stream)[key]
+
+
+def _input_hash(stage: dict) -> str:
+    """
+    Hash of the contents of all a stage's input files, its raw data files, and its command
+
+    The raw data files are big and on RDSF, so their size and modification time
+    are hashed instead of their contents
+
+    """
+    hasher = hashlib.sha1(json.dumps(stage["command"][1:]).encode())
+
+    for pattern in stage["inputs"]:
+        paths = sorted(ROOT.glob(pattern))
+        assert paths, f"Input {pattern} not found"
+
+        for path in paths:
+            hasher.update(str(path.relative_to(ROOT)).encode())
+            hasher.update(hashlib.sha1(path.read_bytes()).digest())
+
+    for key in stage.get("data", []):
+        path = _data_path(key)
+        assert path.is_file(), f"Data file {path} not found"
+
+        stat = path.stat()
+        hasher.update(f"{key} {stat.st_size} {stat.st_mtime_ns}".encode())
+
+    return hasher.hexdigest()
+
+
+def _run(name: str, stage: dict) -> tuple[int, float]:
+    """
+    Run a stage, writing its output to a log file
+
+    :returns: the return code and time taken in seconds
+
+    """
+    start = time.perf_counter()
+    with open(LOG_DIR / f"{name}.log", "w") as log:
+        result = subprocess.run(
+            stage["command"], cwd=ROOT, stdout=log, stderr=subprocess.STDOUT
+        )
+
+    return result.returncode, time.perf_counter() - start
+
+
+def main(*, force: list[str], jobs: int):
+    """
+    Run the stages that need running, as soon as the stages they depend on are done
+
+    """
+    assert set(force) <= set(STAGES), f"Unknown stages: {set(force) - set(STAGES)}"
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+
+    try:
+        with open(STATE_FILE, "r") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = {}
+
+    dependencies = _dependencies(STAGES)
+    status, timings, hashes = {}, {}, {}
+    running = {}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(status) < len(STAGES):
+            for name, stage in STAGES.items():
+                if name in status or name in running.values():
+                    continue
+
+                # Wait for the stages this one depends on, giving up if any of them failed
+                dep_status = {status.get(dep) for dep in dependencies[name]}
+                if dep_status & {"failed", "blocked"}:
+                    status[name] = "blocked"
+                    continue
+                if not dep_status <= {"ran", "up to date"}:
+                    continue
+
+                # Hash the inputs before running, so that anything changed while
+                # the stage is running is picked up next time
+                hashes[name] = _input_hash(stage)
+                if (
+                    name not in force
+                    and state.get(name) == hashes[name]
+                    and all((ROOT / path).exists() for path in stage["outputs"])
+                ):
+                    status[name] = "up to date"
+                    continue
+
+                print(f"Running {name}")
+                running[executor.submit(_run, name, stage)] = name
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                returncode, timings[name] = future.result()
+
+                print((LOG_DIR / f"{name}.log").read_text(), end="")
+                if returncode:
+                    status[name] = "failed"
+                    print(f"{name} failed with return code {returncode}")
+                    continue
+
+                status[name] = "ran"
+                state[name] = hashes[name]
+                with open(STATE_FILE, "w") as f:
+                    json.dump(state, f, indent=1)
+
+    print(f"\n{'stage':<20} {'status':<12} time")
+    for name in STAGES:
+        duration = f"{timings[name]:.1f}s" if name in timings else ""
+        print(f"{name:<20} {status[name]:<12} {duration}")
+    print(f"Total: {time.perf_counter() - start:.1f}s")
+
+    if any(s in {"failed", "blocked"} for s in status.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--force",
+        nargs="*",
+        default=[],
+        choices=list(STAGES),
+        help="run these stages even if they're up to date, e.g. to pick up new data from RDSF",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=len(STAGES),
+        help="maximum number of stages to run at once",
+    )
+
+    main(**vars(parser.parse_args()))
@@ -4,9 +4,37 @@ Tests for the smartwatch modules
 Some are UT, some are bigger
 
 """
+import os
+import sys
+import logging
+import sqlite3
+import pathlib
+from functools import partial
+
+import numpy as np
 import pandas as pd
 
-from ema import clean
+# The pipeline scripts aren't in a package
+sys.path.append(str(pathlib.Path(__file__).parents[1] / "mlm_pipeline"))
+sys.path.append(str(pathlib.Path(__file__).parents[1] / "mlm_pipeline" / "python"))
+
+import run
+import create_csv
+import convert_cwa
+import demographic_plots
+from ema import (
+    analysis,
+    clean,
+    codebook,
+    cwa,
+    diagnostics,
+    filecache,
+    parse,
+    plotting,
+    read,
+    util,
+    windows,
+)
 
 
 def test_duplicates():
@@ -32,3 +60,1016 @@ def test_duplicates():
     ]
 
     assert all(duplicates == expected_duplicates)
+
+
+def test_combine_date_time():
+    """
+    Check that parsing unique dates/times gives the same as parsing the strings
+
+    """
+    dates = pd.Series(["01Apr2022", "02Apr2022", "01Apr2022", "30Apr2022"])
+    times = pd.Series(["08:00:01", "23:59:59", "00:00:00", "08:00:01"])
+
+    expected = pd.to_datetime(dates + times, format=r"%d%b%Y%H:%M:%S")
+    combined = util.combine_date_time(dates, times, date_format=r"%d%b%Y")
+
+    assert (combined == expected).all()
+
+
+def test_parallel_clean():
+    """
+    Check that cleaning in parallel gives exactly the same as cleaning serially
+
+    """
+    rng = np.random.default_rng(0)
+    n_entries = 2000
+
+    # Some random entries for a few participants, some with the same timestamp
+    p_ids = rng.integers(0, 25, n_entries)
+    start = pd.Timestamp("2022-03-25") + pd.to_timedelta(p_ids % 20, "D")
+    times = start + pd.to_timedelta(rng.integers(-86400, 9 * 86400, n_entries), "s")
+    meal_df = pd.DataFrame(
+        {
+            "p_id": p_ids,
+            "meal_type": rng.choice(
+                ["Meal", "Drink", "Snack", "No response", "No food/drink"], n_entries
+            ),
+            "portion_size": rng.integers(0, 2, n_entries),
+            "utensil": rng.integers(0, 2, n_entries),
+            "location": rng.integers(0, 2, n_entries),
+            "catchup_flag": rng.random(n_entries) < 0.1,
+        },
+        index=pd.DatetimeIndex(times.floor("min"), name="Datetime"),
+    )
+    meal_df["delta"] = meal_df.index - start
+
+    serial = clean.clean_meal_info(meal_df, keep_catchups=False)
+    parallel = clean.clean_meal_info(
+        meal_df, keep_catchups=False, n_workers=3, shard_size=4
+    )
+
+    pd.testing.assert_frame_equal(serial, parallel)
+
+
+def test_charge_periods():
+    """
+    Check that we find the right charging/discharging periods
+
+    """
+    levels = [1, 2, 3, 3, 4, 5, 3, 2, 2, 1, 5, 5, 5]
+    p_ids = [1] * 10 + [2] * 3
+    times = pd.Timestamp("2022-04-01") + pd.to_timedelta(np.arange(13), "h")
+
+    battery_df = pd.DataFrame(
+        {"p_id": p_ids, "battery_lvl": levels}, index=pd.DatetimeIndex(times)
+    )
+    battery_df["delta"] = battery_df.index - pd.Timestamp("2022-03-31")
+
+    periods = read.charge_periods(battery_df)
+
+    assert list(periods["direction"]) == [1, 1, -1, -1]
+    assert list(periods["start"]) == list(times[[0, 3, 5, 8]])
+    assert list(periods["end"]) == list(times[[2, 5, 7, 9]])
+    assert list(periods["rate"]) == [1.0, 1.0, -1.5, -1.0]
+
+    charges, discharges = read._charge_and_discharges(battery_df)
+    assert charges == {1: 2, 2: 0}
+    assert discharges == {1: 2, 2: 0}
+
+
+def _write_cwa(
+    path, start: pd.Timestamp, n_blocks: int, *, fractional: bool = False
+) -> None:
+    """
+    Write a CWA file holding random 6-axis data sampled at 100Hz
+
+    :param fractional: store the part of a second of each block's time in the
+                       fractional field, instead of as a sample offset
+
+    """
+    rng = np.random.default_rng(0)
+    header = bytearray(1024)
+    header[:4] = b"MD" + (1020).to_bytes(2, "little")
+
+    sectors = np.zeros(
+        n_blocks,
+        dtype=[("fields", "u1", 30), ("data", "<i2", 240), ("checksum", "<u2")],
+    )
+    fields = sectors["fields"]
+    fields[:, :4] = np.frombuffer(b"AX" + (508).to_bytes(2, "little"), "u1")
+
+    # 40 samples per block
+    starts = start + pd.to_timedelta(np.arange(n_blocks) * 0.4, "s")
+    whole = starts.floor("s")
+    packed = (
+        ((whole.year.values - 2000) << 26)
+        | (whole.month.values << 22)
+        | (whole.day.values << 17)
+        | (whole.hour.values << 12)
+        | (whole.minute.values << 6)
+        | whole.second.values
+    ).astype("<u4")
+    offsets = -np.round((starts - whole).total_seconds() * 100).values.astype("<i2")
+    fields[:, 14:18] = packed.view("u1").reshape(-1, 4)
+    fields[:, 24] = 0x4A
+    fields[:, 25] = 0x62
+    if fractional:
+        # In units of 1/32768s, with the top bit set
+        fraction = np.round((starts - whole).total_seconds() * 32768).values
+        fraction = fraction.astype(np.int64)
+        fields[:, 4:6] = (0x8000 | fraction).astype("<u2").view("u1").reshape(-1, 2)
+
+        # The reader adds this many samples to the offset, so take them off here
+        offsets = -(((fraction << 1) * 100) >> 16).astype("<i2")
+    fields[:, 26:28] = offsets.view("u1").reshape(-1, 2)
+    fields[:, 28] = 40
+    sectors["data"] = rng.integers(-1000, 1000, (n_blocks, 240))
+
+    # Words in each sector should sum to 0
+    words = sectors.view("<u2").reshape(n_blocks, 256)
+    sectors["checksum"] = -words[:, :255].sum(axis=1, dtype=np.uint16)
+
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write(sectors.tobytes())
+
+
+def test_cwa_time_range(tmp_path):
+    """
+    Check that reading a time range from a CWA file gives the same samples as
+    decoding the whole file and slicing it
+
+    """
+    path = tmp_path / "test.cwa"
+    _write_cwa(path, pd.Timestamp("2022-03-01 08:00:00.3"), 500)
+
+    full = read.accel_info(str(path))
+    assert not (tmp_path / "test.cwa.idx.npz").exists()
+
+    for start, end in [
+        ("2022-03-01 08:00:30.005", "2022-03-01 08:01:00"),
+        ("2022-03-01 07:00", "2022-03-01 08:00:05"),
+        ("2022-03-01 08:03:10", None),
+        ("2022-03-01 09:00", "2022-03-01 10:00"),
+    ]:
+        start, end = pd.Timestamp(start), end and pd.Timestamp(end)
+        pd.testing.assert_frame_equal(
+            read.accel_info(str(path), start, end), full[start:end]
+        )
+
+    # The index should have been stored and agree with the file
+    assert (tmp_path / "test.cwa.idx.npz").exists()
+    index = cwa.block_index(str(path))
+    assert index["data_offset"] == 1024
+    assert index["times"][0] == pd.Timestamp("2022-03-01 08:00:00.3")
+    assert len(index["times"]) == 500
+
+
+def test_cwa_fractional_timestamps(tmp_path):
+    """
+    Check block times are decoded when the sub-second part of the time is in
+    the fractional field, which also changes the sample offset
+
+    """
+    path = tmp_path / "test.cwa"
+    start = pd.Timestamp("2022-03-01 08:00:00.3")
+    _write_cwa(path, start, 50, fractional=True)
+
+    # The fractional field only has a resolution of 1/32768s
+    starts = start + pd.to_timedelta(np.arange(50) * 0.4, "s")
+    whole = starts.floor("s")
+    fraction = np.round((starts - whole).total_seconds() * 32768).values
+    expected = whole + pd.to_timedelta(np.round(fraction / 32768 * 1e9), "ns")
+
+    times = cwa.block_index(str(path))["times"]
+    assert (pd.DatetimeIndex(times) == expected).all()
+    assert (pd.DatetimeIndex(times) != starts).any()
+
+
+def test_filecache(tmp_path):
+    """
+    Check that files are copied to the cache, recopied when they change and
+    evicted least recently used first
+
+    """
+    source_dir, cache_dir = tmp_path / "source", tmp_path / "cache"
+    source_dir.mkdir()
+    for name in "abc":
+        (source_dir / name).write_bytes(bytes(100))
+
+    local_a = filecache.cached_path(source_dir / "a", cache_dir, 250)
+    assert local_a.parent == cache_dir
+    assert local_a.read_bytes() == bytes(100)
+
+    # Use a again after b, so that b is the least recently used
+    local_b = filecache.cached_path(source_dir / "b", cache_dir, 250)
+    filecache.cached_path(source_dir / "a", cache_dir, 250)
+    filecache.cached_path(source_dir / "c", cache_dir, 250)
+    assert local_a.exists()
+    assert not local_b.exists()
+
+    # Changing the source should update the cached copy
+    (source_dir / "a").write_bytes(bytes(120))
+    assert filecache.cached_path(source_dir / "a", cache_dir, 250).stat().st_size == 120
+
+
+def test_nearest_entries():
+    """
+    Check we find the right entries either side of some epochs
+
+    """
+    entries = pd.DataFrame(
+        {"p_id": [1, 1, 2, 1], "meal_type": ["Meal", "Snack", "Drink", "Meal"]},
+        index=pd.to_datetime(
+            [
+                "2022-03-01 12:00",
+                "2022-03-01 15:00",
+                "2022-03-01 13:00",
+                "2022-03-01 19:00",
+            ]
+        ),
+    )
+    epochs = pd.DataFrame(
+        {
+            "p_id": [1, 2, 1, 1, 3],
+            "time": pd.to_datetime(
+                [
+                    "2022-03-01 11:00",
+                    "2022-03-01 14:00",
+                    "2022-03-01 15:00",
+                    "2022-03-01 20:00",
+                    "2022-03-01 14:00",
+                ]
+            ),
+        },
+        index=[5, 4, 3, 2, 1],
+    )
+
+    for n_workers in (1, 2):
+        nearest = analysis.nearest_entries(epochs, entries, n_workers=n_workers)
+
+        assert (nearest.index == epochs.index).all()
+        assert nearest["prev_meal_type"].fillna("").tolist() == [
+            "",
+            "Drink",
+            "Snack",
+            "Meal",
+            "",
+        ]
+        assert nearest["next_meal_type"].fillna("").tolist() == [
+            "Meal",
+            "",
+            "Meal",
+            "",
+            "",
+        ]
+        assert nearest["time_since_prev"].iloc[2] == pd.Timedelta(0)
+        assert nearest["time_to_next"].iloc[0] == pd.Timedelta(1, "hour")
+
+
+def test_compliance_cube():
+    """
+    Check the compliance cube agrees with counting the entries directly
+
+    """
+    rng = np.random.default_rng(0)
+    n_entries = 1000
+    meal_info = pd.DataFrame(
+        {
+            "p_id": rng.integers(0, 10, n_entries),
+            "meal_type": rng.choice(["Meal", "Snack", "No response"], n_entries),
+            "delta": pd.to_timedelta(rng.integers(86400, 8 * 86400, n_entries), "s"),
+        },
+        index=pd.Timestamp("2022-03-01")
+        + pd.to_timedelta(rng.integers(0, 86400, n_entries), "s"),
+    )
+
+    cube = analysis.ComplianceCube.from_entries(meal_info, by_hour=True)
+    assert cube.values.sum() == n_entries
+
+    expected = (
+        meal_info.groupby(["p_id", meal_info["delta"].dt.days])
+        .size()
+        .unstack(fill_value=0)
+    )
+    assert (cube.marginal("p_id", "day").values == expected.values).all()
+    assert (cube.marginal("day", "p_id").values == expected.values.T).all()
+
+    snacks = meal_info[(meal_info["meal_type"] == "Snack") & (meal_info["p_id"] == 3)]
+    assert cube.marginal("hour", p_id=[3], meal_type=["Snack"]).sum() == len(snacks)
+
+    responded = (meal_info["meal_type"] != "No response").groupby(meal_info["p_id"])
+    assert np.allclose(cube.response_rate("p_id").values, responded.mean().values)
+
+
+def test_calendar():
+    """
+    Check the calendar agrees with comparing against each interval directly
+
+    """
+    rng = np.random.default_rng(0)
+    times = pd.DatetimeIndex(
+        pd.Timestamp("2022-03-01")
+        + pd.to_timedelta(rng.integers(0, 90 * 86400, 1000), "s")
+    ).append(
+        pd.DatetimeIndex(["2022-04-02", "2022-05-02", "2022-05-02 00:00:01", pd.NaT])
+    )
+
+    # Overlapping, and with no end
+    intervals = {
+        "ramadan": tuple(util.ramadan_2022()),
+        "holiday": (pd.Timestamp("2022-04-20"), pd.Timestamp("2022-04-25 12:00")),
+        "after": (pd.Timestamp("2022-04-22"), None),
+    }
+    flags = util.Calendar(intervals).flags(pd.Series(times))
+
+    for name, (start, end) in intervals.items():
+        expected = start <= times
+        if end is not None:
+            expected &= times <= end
+        assert (flags[name].values == expected).all()
+
+    start, end = util.ramadan_2022()
+    assert (
+        util.in_ramadan_2022(times, verbose=False)
+        == ((start <= times) & (times <= end))
+    ).all()
+
+
+def test_date_features():
+    """
+    Check calendar features gathered from the date table match computing them per row
+
+    """
+    rng = np.random.default_rng(0)
+    times = pd.DatetimeIndex(
+        pd.Timestamp("2022-03-01")
+        + pd.to_timedelta(rng.integers(0, 90 * 86400, 1000), "s")
+    ).append(pd.DatetimeIndex([pd.NaT]))
+    times = pd.Series(times, index=rng.permutation(len(times)))
+
+    features = util.date_features(times)
+    assert (features.index == times.index).all()
+    assert features.iloc[-1].isna().all()
+
+    features, times = features.iloc[:-1], times.iloc[:-1]
+    assert (features["weekday"] == times.dt.day_name()).all()
+    assert (features["weekend"] == (times.dt.dayofweek >= 5)).all()
+    assert (
+        features["ramadan"].values
+        == util.in_ramadan_2022(pd.DatetimeIndex(times.dt.normalize()), verbose=False)
+    ).all()
+
+
+def test_codebook():
+    """
+    Check decoding with a codebook agrees with looking up each answer, and
+    that the codebook spreadsheet is parsed into the right answers
+
+    """
+    answers = read.income_codebook()["income_1"]
+    values = pd.Series([1, 2, -9, np.nan, 7, -8, 2.0], index=list("abcdefg"))
+
+    decoded = codebook.income_codebooks()["income_1"].decode(values)
+    assert (decoded.index == values.index).all()
+    assert decoded.astype(object).where(decoded.notna(), None).tolist() == [
+        answers.get(value) for value in values
+    ]
+
+    sheet = pd.DataFrame(
+        {
+            "Variable Name": ["q1", None, None, "q2", "q3", None],
+            "Variable Label": ["Q one", None, None, "Q two", "Q three", None],
+            "Answer Code": [None, 1, 2, None, None, "1"],
+            "Answer Label": [None, "Yes", "No", "Open ended", None, "A"],
+        }
+    )
+    parsed = codebook._parse_full_codebook(sheet)
+    assert list(parsed) == ["q1", "q3"]
+    assert parsed["q1"] == {
+        "question": "Q one",
+        "codes": [1, 2],
+        "labels": ["Yes", "No"],
+    }
+
+
+def test_participant_registry():
+    """
+    Check the registry's groups and membership checks agree with filtering the table
+
+    """
+    rng = np.random.default_rng(0)
+    n_participants = 100
+    info = pd.DataFrame(
+        {
+            "in_questionnaire": rng.random(n_participants) < 0.9,
+            "in_feasibility": rng.random(n_participants) < 0.5,
+            "consented": rng.random(n_participants) < 0.5,
+            "smartwatchwilling": rng.choice([1, 2, np.nan], n_participants),
+            "collection_date": rng.choice(
+                [pd.Timestamp("2022-04-01"), pd.NaT], n_participants
+            ),
+        },
+        index=rng.permutation(n_participants) * 7 + 1000,
+    )
+
+    registry = read.ParticipantRegistry(info)
+    assert (registry.consented == np.sort(info.index[info["consented"]])).all()
+
+    expected = info.index[info["in_feasibility"] & info["collection_date"].isnull()]
+    assert set(registry.no_collection_date) == set(expected)
+
+    # Including IDs that aren't in the table at all
+    ids = np.concatenate([info.index.values, [0, 1001, 10**6]])
+    assert (
+        registry.contains(registry.smartwatch_willing, ids)
+        == pd.Series(ids).isin(info.index[info["smartwatchwilling"] == 1]).values
+    ).all()
+    assert not registry.contains(registry.consented, 0)
+
+
+def test_diagnostics(capsys):
+    """
+    Check that catch-up events are collected as records, and not printed
+
+    """
+    times = pd.date_range("2022-04-05 09:00", periods=4, freq="2min")
+    meal_info = pd.DataFrame(
+        {
+            "p_id": [7] * 4,
+            "meal_type": ["Catch-up start", "Meal", "No response", "Meal"],
+            "catchup_category": ["Open-ended", None, None, None],
+        },
+        index=times,
+    )
+
+    with diagnostics.collect() as collector:
+        flagged = clean.flag_catchup_entries(meal_info)
+        parse.extract_meals(meal_info, {"Meal"})
+
+    assert flagged["catchup_flag"].tolist() == [False, True, False, False]
+
+    table = collector.table()
+    assert table["stage"].tolist() == [
+        "flag_catchup_entries",
+        "flag_catchup_entries",
+        "extract_meals",
+    ]
+    assert table.loc[0, "p_id"] == 7
+    assert table.loc[0, "time"] == times[0]
+
+    # Nothing printed, and nothing collected once we're out of the with block
+    clean.flag_catchup_entries(meal_info)
+    assert len(collector.records) == 3
+    assert capsys.readouterr().out == ""
+
+
+def test_resample_battery_off_grid():
+    """
+    Check participants whose last reading is after the last grid point
+    don't overlap with the next participant's readings
+
+    """
+    start = pd.Timestamp("2022-04-01 12:00")
+    times = [start, start + pd.Timedelta(minutes=9)]
+    battery_df = pd.DataFrame(
+        {"p_id": [1, 1, 2, 2], "battery_lvl": [100, 91, 50, 59]},
+        index=pd.DatetimeIndex(times * 2),
+    )
+
+    p_ids, grid, levels, gaps = analysis.resample_battery(battery_df)
+
+    assert p_ids.tolist() == [1, 2]
+    assert (pd.DatetimeIndex(grid) == [start, start + pd.Timedelta(minutes=5)]).all()
+    assert np.allclose(levels, [[100, 95], [50, 55]])
+    assert not gaps.any()
+
+
+def _use_raw_meal_info(tmp_path, monkeypatch) -> pd.DataFrame:
+    """
+    Point the store of cleaned entries at a temporary dir, and make the raw smartwatch
+    rows a small dataframe of three participants' entries that can be changed
+
+    """
+    rows = []
+    for p_id in (1, 2, 3):
+        for day in range(1, 8):
+            rows.append((p_id, f"{day + 1:02}Apr2022", "12:00:00", "Meal"))
+    # A normal catch-up for participant 1
+    rows[1:1] = [
+        (1, "03Apr2022", "08:01:00", "Catch-up start"),
+        (1, "03Apr2022", "08:01:10", "Snack"),
+        (1, "03Apr2022", "08:01:40", "Catch-up end"),
+    ]
+    # An open-ended catch-up at the end of participant 2's entries
+    rows.insert(17, (2, "08Apr2022", "20:00:00", "Catch-up start"))
+
+    raw_meal_df = pd.DataFrame(rows, columns=["p_id", "date", "timestamp", "meal_type"])
+    raw_meal_df[["portion_size", "utensil", "location"]] = 1
+    info = pd.DataFrame(
+        {
+            "distribution_date": pd.Timestamp("2022-04-01"),
+            "watch_distributed": True,
+        },
+        index=pd.Index([1, 2, 3], name="p_id"),
+    )
+
+    monkeypatch.setattr(read, "_data_dir", lambda: tmp_path)
+    monkeypatch.setattr(read, "participant_info", lambda: info)
+    monkeypatch.setattr(read, "raw_meal_info", lambda: raw_meal_df)
+    monkeypatch.setattr(read, "_source_stat", lambda key: [0, 0])
+
+    return raw_meal_df
+
+
+def test_incremental_clean(tmp_path, monkeypatch):
+    """
+    Check that the store of cleaned entries matches cleaning everything again,
+    after one participant's raw rows change
+
+    """
+    raw_meal_df = _use_raw_meal_info(tmp_path, monkeypatch)
+
+    def full_recompute():
+        return clean.clean_meal_info(
+            read.process_meal_info(raw_meal_df), keep_catchups=False
+        )
+
+    pd.testing.assert_frame_equal(
+        clean.cleaned_smartwatch(keep_catchups=False, incremental=True),
+        full_recompute(),
+    )
+
+    # Change one of participant 3's entries; only they get cleaned again
+    raw_meal_df.loc[raw_meal_df["p_id"] == 3, "meal_type"] = "Snack"
+    assert clean.refresh_cleaned_store(keep_catchups=False) == [3]
+
+    pd.testing.assert_frame_equal(
+        clean.cleaned_smartwatch(keep_catchups=False, incremental=True),
+        full_recompute(),
+    )
+
+
+def test_participant_flags(tmp_path, monkeypatch):
+    """
+    Check the stored per-participant flags match the cleaned entries' flags, are
+    loaded without reading the raw rows, and are updated when the raw files change
+
+    """
+    raw_meal_df = _use_raw_meal_info(tmp_path, monkeypatch)
+
+    def expected_flags():
+        cleaned = clean.clean_meal_info(
+            read.process_meal_info(raw_meal_df), keep_catchups=False
+        )
+        return cleaned.groupby("p_id")[clean.PARTICIPANT_FLAGS].first()
+
+    flags = clean.participant_flags(keep_catchups=False)
+    assert not flags["early_stop"].any()
+    pd.testing.assert_frame_equal(flags, expected_flags(), check_dtype=False)
+
+    # Participant 3 stops entering things before day 7
+    raw_meal_df.loc[
+        (raw_meal_df["p_id"] == 3) & (raw_meal_df["date"] == "08Apr2022"), "meal_type"
+    ] = "No response"
+
+    # The raw files look the same, so the stored flags are loaded without reading them
+    def no_raw_meal_info():
+        raise AssertionError("Read the raw meal info")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(read, "raw_meal_info", no_raw_meal_info)
+        flags = clean.participant_flags(keep_catchups=False)
+    assert not flags["early_stop"].any()
+
+    # Asking for a refresh, or the raw file changing, updates them
+    assert clean.participant_flags(keep_catchups=False, refresh=True)[
+        "early_stop"
+    ].tolist() == [False, False, True]
+
+    raw_meal_df.loc[raw_meal_df["p_id"] == 3, "meal_type"] = "Meal"
+    monkeypatch.setattr(read, "_source_stat", lambda key: [1, 1])
+
+    flags = clean.participant_flags(keep_catchups=False)
+    assert not flags["early_stop"].any()
+    pd.testing.assert_frame_equal(flags, expected_flags(), check_dtype=False)
+
+
+def test_event_store(tmp_path, monkeypatch):
+    """
+    Check the event store adds new databases, skips ones it has already read or
+    can't read, and removes the events from databases that are deleted
+
+    """
+    monkeypatch.setattr(read, "_data_dir", lambda: tmp_path)
+    battery_dir = tmp_path / "battery_dbs"
+    battery_dir.mkdir()
+
+    def write_db(p_id, levels):
+        path = battery_dir / f"watch_{p_id}_1.db"
+        conn = sqlite3.connect(path)
+        pd.DataFrame(
+            {
+                "eventdate": "2022-04-02",
+                "eventtime": [f"12:0{i}:00" for i in range(len(levels))],
+                "eventdesc": [f"Battery level {level}%" for level in levels],
+            }
+        ).to_sql("Event", conn, index=False)
+        conn.close()
+        return path
+
+    write_db(1, [100, 90])
+    path_2 = write_db(2, [50])
+    broken = battery_dir / "watch_3_1.db"
+    broken.write_bytes(b"not a database" * 100)
+
+    def no_read_bytes(path):
+        raise AssertionError(f"Read all of {path}")
+
+    with diagnostics.collect() as collector:
+        assert [path.name for path in read.update_event_store()] == [
+            "watch_1_1.db",
+            "watch_2_1.db",
+        ]
+
+        # The broken database isn't tried again, and databases that can be
+        # read aren't hashed
+        write_db(4, [10])
+        with monkeypatch.context() as patch:
+            patch.setattr(pathlib.Path, "read_bytes", no_read_bytes)
+            assert [path.name for path in read.update_event_store()] == ["watch_4_1.db"]
+            assert read.update_event_store() == []
+
+        # Touching the broken database means it's hashed, but not tried again
+        os.utime(broken, ns=(1, 1))
+        assert read.update_event_store() == []
+        with monkeypatch.context() as patch:
+            patch.setattr(pathlib.Path, "read_bytes", no_read_bytes)
+            assert read.update_event_store() == []
+    assert collector.table()["stage"].tolist() == ["update_event_store"]
+
+    events = read.smartwatch_events(battery_only=True)
+    assert events["p_id"].tolist() == [1, 1, 2, 4]
+    assert events["battery_lvl"].tolist() == [100, 90, 50, 10]
+    assert read.smartwatch_events(sources=["watch_2_1.db"])["p_id"].tolist() == [2]
+
+    # Delete two databases and fix the broken one
+    path_2.unlink()
+    (battery_dir / "watch_4_1.db").unlink()
+    broken.unlink()
+    write_db(3, [75])
+
+    assert [path.name for path in read.update_event_store()] == ["watch_3_1.db"]
+    assert read.smartwatch_events()["p_id"].tolist() == [1, 1, 3]
+
+
+def test_meal_windows_real_entries(tmp_path, monkeypatch):
+    """
+    Check that by default windows are only built before the entries a participant
+    made, not catch-up markers or No response
+
+    """
+    times = pd.date_range("2022-04-02 12:00", periods=5, freq="h", name="Datetime")
+    entries = pd.DataFrame(
+        {
+            "p_id": 1,
+            "meal_type": [
+                "Catch-up start",
+                "Meal",
+                "No response",
+                "No food/drink",
+                "Catch-up end",
+            ],
+        },
+        index=times,
+    )
+    samples = pd.DataFrame(
+        0.0,
+        index=pd.date_range(
+            times[0] - pd.Timedelta(minutes=1),
+            times[-1],
+            freq=pd.Timedelta(seconds=1 / util.SAMPLE_RATE_HZ),
+        ),
+        columns=list(windows.CHANNELS),
+    )
+
+    monkeypatch.setattr(clean, "cleaned_smartwatch", lambda **_: entries)
+    monkeypatch.setattr(
+        read, "cwa_files", lambda: pd.DataFrame({"p_id": [1], "path": ["1.cwa"]})
+    )
+    monkeypatch.setattr(read, "is_converted", lambda path: True)
+    monkeypatch.setattr(
+        read, "converted_accel_info", lambda path, start, end: samples[start:end]
+    )
+
+    window_length = pd.Timedelta(seconds=1)
+    _, metadata = windows.build_meal_windows(
+        tmp_path / "real", window_length=window_length
+    )
+    assert metadata["meal_type"].tolist() == ["Meal", "No food/drink"]
+
+    _, metadata = windows.build_meal_windows(
+        tmp_path / "all", window_length=window_length, meal_types=None
+    )
+    assert metadata["meal_type"].tolist() == entries["meal_type"].tolist()
+
+
+def test_feather_types(tmp_path):
+    """
+    Check that the feather file keeps the nullable integer and category types,
+    and that it is removed when we stop writing it
+
+    """
+    table = pd.DataFrame(
+        {
+            "p_id": [1, 1, 2],
+            "weekday": ["Sunday", "Monday", "Friday"],
+            "over_2_days_in_school": [1, np.nan, 0],
+            "Datetime": pd.date_range("2022-04-02", periods=3, freq="h"),
+        }
+    )
+    path = tmp_path / "model_df.csv"
+
+    create_csv.write_table(table, path, feather=True)
+    feather = pd.read_feather(path.with_suffix(".feather"))
+
+    assert feather["p_id"].dtype == "Int64"
+    assert feather["over_2_days_in_school"].dtype == "Int8"
+    assert feather["over_2_days_in_school"].isna().tolist() == [False, True, False]
+    assert feather["weekday"].cat.categories.tolist() == ["Friday", "Monday", "Sunday"]
+    pd.testing.assert_frame_equal(
+        feather.astype({"weekday": object, "over_2_days_in_school": float}),
+        table.astype({"p_id": "Int64"}),
+        check_dtype=False,
+    )
+    assert (pd.read_csv(path)["weekday"] == table["weekday"]).all()
+
+    create_csv.write_table(table, path, feather=False)
+    assert not path.with_suffix(".feather").exists()
+
+
+def test_binomial_table():
+    """
+    Check the binomial table counts every prompt once and keeps the covariates
+
+    """
+    rng = np.random.default_rng(0)
+    n_entries = 500
+
+    model_df = pd.DataFrame(
+        {
+            "p_id": rng.integers(0, 10, n_entries),
+            "day": rng.integers(1, 8, n_entries),
+            "meal_type": rng.choice(["Meal", "No response"], n_entries),
+            "Datetime": pd.Timestamp("2022-04-02")
+            + pd.to_timedelta(rng.integers(0, 86400, n_entries), "s"),
+        }
+    )
+    model_df["entry"] = (model_df["meal_type"] == "Meal").astype(int)
+
+    # Per-participant covariates, one of them sometimes missing
+    model_df["sex"] = model_df["p_id"] % 2
+    model_df["over_2_days_in_school"] = np.where(
+        model_df["p_id"] == 3, np.nan, model_df["p_id"] > 4
+    )
+
+    table = create_csv.binomial_table(model_df)
+
+    # Every prompt is counted once
+    assert (table["successes"] + table["failures"] == table["trials"]).all()
+    assert table["trials"].sum() == len(model_df)
+    assert table["successes"].sum() == model_df["entry"].sum()
+
+    # Same counts per participant-day as grouping the entries directly
+    counts = model_df.groupby(["p_id", "day"])["entry"].agg(["sum", "size"])
+    table = table.set_index(["p_id", "day"]).sort_index()
+    assert (table["successes"] == counts["sum"]).all()
+    assert (table["trials"] == counts["size"]).all()
+
+    # The covariates are kept, including the missing ones
+    covariates = (
+        model_df.groupby(["p_id", "day"])[["sex", "over_2_days_in_school"]]
+        .first()
+        .astype(float)
+    )
+    pd.testing.assert_frame_equal(
+        table[["sex", "over_2_days_in_school"]].astype(float), covariates
+    )
+
+
+def test_pipeline_runner(tmp_path, monkeypatch, capsys):
+    """
+    Check that stages are skipped when they're up to date, and re-run along with
+    the stages after them when their inputs or raw data change
+
+    """
+    data_file = tmp_path / "raw.csv"
+    data_file.write_text("1")
+    (tmp_path / "in.txt").write_text("a")
+
+    def copy(source, dest):
+        code = f"import shutil; shutil.copyfile({source!r}, {dest!r})"
+        return [sys.executable, "-c", code]
+
+    stages = {
+        "first": {
+            "command": copy("in.txt", "middle.txt"),
+            "inputs": ["in.txt"],
+            "data": ["raw"],
+            "outputs": ["middle.txt"],
+        },
+        "second": {
+            "command": copy("middle.txt", "out.txt"),
+            "inputs": ["middle.txt"],
+            "outputs": ["out.txt"],
+        },
+    }
+    monkeypatch.setattr(run, "ROOT", tmp_path)
+    monkeypatch.setattr(run, "STATE_FILE", tmp_path / "state.json")
+    monkeypatch.setattr(run, "LOG_DIR", tmp_path / "logs")
+    monkeypatch.setattr(run, "STAGES", stages)
+    monkeypatch.setattr(run, "_data_path", lambda key: tmp_path / f"{key}.csv")
+
+    def ran():
+        run.main(force=[], jobs=2)
+        output = capsys.readouterr().out
+        return [name for name in stages if f"Running {name}" in output]
+
+    assert ran() == ["first", "second"]
+    assert (tmp_path / "out.txt").read_text() == "a"
+
+    # Nothing changed
+    assert ran() == []
+
+    # The second stage's output was deleted
+    (tmp_path / "out.txt").unlink()
+    assert ran() == ["second"]
+
+    # The first stage's input changed
+    (tmp_path / "in.txt").write_text("b")
+    assert ran() == ["first", "second"]
+    assert (tmp_path / "out.txt").read_text() == "b"
+
+    # The raw data changed, but the first stage wrote the same output
+    data_file.write_text("22")
+    assert ran() == ["first"]
+
+
+def test_plot_hash_arguments():
+    """
+    Check that the hash of a figure's inputs changes with the arguments bound to
+    its plotting function
+
+    """
+    data = pd.DataFrame({"weekday": [1, 2, 2, 6]})
+    lookup = dict(demographic_plots.DAY_LOOKUP)
+
+    def input_hash(day_lookup):
+        return demographic_plots._input_hash(
+            partial(demographic_plots.weekday_hist, day_lookup=day_lookup), data
+        )
+
+    assert input_hash(lookup) == input_hash(dict(lookup))
+
+    lookup[1] = "Mon"
+    assert input_hash(lookup) != input_hash(demographic_plots.DAY_LOOKUP)
+
+
+def test_entry_time_counts():
+    """
+    Check the stacked bar counts are the same as histogramming each meal type's
+    entry times separately
+
+    """
+    rng = np.random.default_rng(0)
+    n_entries = 1000
+
+    start = pd.Timestamp("2022-04-01")
+    times = start + pd.to_timedelta(rng.integers(0, 10 * 86400, n_entries), "s")
+    meal_df = pd.DataFrame(
+        {
+            "meal_type": rng.choice(
+                ["Meal", "Snack", "No response", "Catch-up start"], n_entries
+            )
+        },
+        index=pd.DatetimeIndex(times).sort_values(),
+    )
+    # An entry on the last bin edge
+    meal_df.loc[pd.Timestamp("2022-04-08")] = "Meal"
+
+    for granularity in ("1D", "6h", pd.date_range("2022-04-02", "2022-04-08")):
+        bins, labels, counts = plotting.entry_time_counts(meal_df, granularity)
+
+        assert labels == ["No response", "Catch-up start", "Meal", "Snack"]
+
+        edges = bins.values.astype("datetime64[ns]").view(np.int64)
+        for label, type_counts in zip(labels, counts):
+            times = meal_df.index[meal_df["meal_type"] == label]
+            expected, _ = np.histogram(
+                times.values.astype("datetime64[ns]").view(np.int64), bins=edges
+            )
+            assert (type_counts == expected).all()
+
+
+def test_participant_entries_per_day():
+    """
+    Check one line is drawn per participant, with a point for each day they
+    made entries on
+
+    """
+    meal_df = pd.DataFrame(
+        {"p_id": [1, 1, 1, 2, 3, 3]},
+        index=pd.DatetimeIndex(
+            [
+                "2022-04-02 12:00",
+                "2022-04-02 18:00",
+                "2022-04-03 12:00",
+                "2022-04-02 09:00",
+                "2022-04-05 12:00",
+                "2022-04-07 12:00",
+            ]
+        ),
+    )
+
+    fig, axis, participant_entries = plotting.participant_entries_per_day(meal_df)
+
+    (lines,) = axis.collections
+    segments = lines.get_segments()
+    assert len(segments) == 3
+    assert [len(segment) for segment in segments] == [2, 1, 2]
+    assert [segment[:, 1].tolist() for segment in segments] == [
+        entries for _, entries in participant_entries.values()
+    ]
+
+    # The markers are one point per participant-day
+    (markers,) = axis.lines
+    assert len(markers.get_xdata()) == 5
+
+    plotting.plt.close(fig)
+
+
+def test_convert_cwa(tmp_path, monkeypatch, capsys):
+    """
+    Check that CWA files are only converted again if they've changed since they
+    were last converted, or if we force it
+
+    """
+    cwa_path = tmp_path / "1234567_1234567890-1.cwa"
+    cwa_path.write_text("1")
+
+    def fake_accel_info(filepath, start=None, end=None):
+        # The "samples" are the contents of the file
+        return pd.DataFrame(
+            {"accel_x": [float(pathlib.Path(filepath).read_text())] * 3},
+            index=pd.date_range("2022-04-02", periods=3, freq="10ms", name="time"),
+        )
+
+    monkeypatch.setattr(read, "_data_dir", lambda: tmp_path)
+    monkeypatch.setattr(read, "accel_info", fake_accel_info)
+    monkeypatch.setattr(
+        read,
+        "participant_info",
+        lambda: pd.DataFrame({"consented": [True]}, index=pd.Index([1])),
+    )
+
+    def convert(force=False):
+        convert_cwa.main(n_workers=1, force=force)
+        return capsys.readouterr().out
+
+    assert not read.is_converted(cwa_path)
+    assert "Converted 1 files" in convert()
+    assert read.is_converted(cwa_path)
+    assert read.converted_accel_info(cwa_path)["accel_x"].tolist() == [1, 1, 1]
+
+    # Up to date
+    output = convert()
+    assert "Skipping 1 files that are already converted" in output
+    assert "Converted 0 files" in output
+
+    # The CWA file changes after it was converted
+    cwa_path.write_text("2")
+    converted_ns = read.converted_accel_path(cwa_path).stat().st_mtime_ns
+    os.utime(cwa_path, ns=(converted_ns + 10**9, converted_ns + 10**9))
+    assert not read.is_converted(cwa_path)
+
+    assert "Converted 1 files" in convert()
+    assert read.converted_accel_info(cwa_path)["accel_x"].tolist() == [2, 2, 2]
+
+    # Forced, even though it's up to date
+    assert "Converted 1 files" in convert(force=True)
+
+
+def test_in_ramadan_quiet():
+    """
+    Check that classifying dates only checks their years if asked to
+
+    """
+    dates = pd.DatetimeIndex(["2021-04-10", "2022-04-10", "2022-05-10"])
+
+    with diagnostics.collect(logging.WARNING) as collector:
+        assert util.in_ramadan_2022(dates).tolist() == [False, True, False]
+    assert collector.table().empty
+
+    with diagnostics.collect(logging.WARNING) as collector:
+        util.in_ramadan_2022(dates, verbose=True)
+    assert collector.table()["stage"].tolist() == ["in_ramadan_2022"]